@@ -60,22 +60,6 @@ import math
 from scipy.spatial.distance import cdist
 import open3d as o3d
 
-def random_quat_tensor(N):
-    """
-    Defines a random quaternion tensor of shape (N, 4)
-    """
-    u = torch.rand(N)
-    v = torch.rand(N)
-    w = torch.rand(N)
-    return torch.stack(
-        [
-            torch.sqrt(1 - u) * torch.sin(2 * math.pi * v),
-            torch.sqrt(1 - u) * torch.cos(2 * math.pi * v),
-            torch.sqrt(u) * torch.sin(2 * math.pi * w),
-            torch.sqrt(u) * torch.sin(2 * math.pi * w),
-        ],
-        dim=-1,
-    )
 def RGB2SH(rgb):
     """
     Converts from RGB values [0,1] to the 0th spherical harmonic coefficient
@@ -1165,13 +1165,18 @@ class Trainer:
             self.checkpoint_dir.mkdir(parents=True, exist_ok=True)
         # save the checkpoint
         ckpt_path: Path = self.checkpoint_dir / f"step-{step:09d}.ckpt"
+        # the model may still be updating adam moments on its side stream
+        self.pipeline.model.wait_optim_maintenance()
         torch.save(
             {
                 "step": step,
                 "pipeline": self.pipeline.module.state_dict()  # type: ignore
                 if hasattr(self.pipeline, "module")
                 else self.pipeline.state_dict(),
-                "optimizers": {k: v.state_dict() for (k, v) in self.optimizers.optimizers.items()},
+                # moments are views into over-allocated storage, the model compacts them before they're serialized
+                "optimizers": {
+                    k: self.pipeline.model.optim_state_dict(v) for (k, v) in self.optimizers.optimizers.items()
+                },
                 "schedulers": {k: v.state_dict() for (k, v) in self.optimizers.schedulers.items()},
                 "scalers": self.grad_scaler.state_dict(),
             },
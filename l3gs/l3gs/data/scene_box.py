@@ -89,17 +89,17 @@ class OrientedBox:
 
     def within(self,pts: Float[Tensor,"n 3"]):
         """Returns a boolean mask indicating whether each point is within the box."""
-        R,T,S = self.R,self.T,self.S.to(pts)
-        H = torch.eye(4, device=pts.device,dtype = pts.dtype)
-        H[:3, :3] = R
-        H[:3, 3] = T
-        H_world2bbox = torch.inverse(H)
-        pts = torch.cat((pts, torch.ones_like(pts[..., :1])), dim=-1)
-        pts = torch.matmul(H_world2bbox,pts.T).T[..., :3]
-
-        comp_l = torch.tensor(-S/2)
-        comp_m = torch.tensor( S/2)
-        mask = torch.all(torch.concat([pts > comp_l, pts < comp_m], dim=-1), dim=-1)
+        # R, T and S usually live on the host, pack them so moving them to the points' device is one copy, not three
+        dev = self.T.device
+        RTS = torch.cat((self.R.to(dev, pts.dtype), self.T.to(pts.dtype)[:, None], self.S.to(dev, pts.dtype)[:, None]), dim=1)
+        RTS = RTS.to(pts.device)
+        R,T,S = RTS[:, :3],RTS[:, 3],RTS[:, 4]
+        # world to box is the rigid inverse [R^T | -R^T T], applied directly as R^T (p - T) (row vectors: (p - T) @ R)
+        # instead of an LU inverse of the 4x4 and a homogeneous matmul
+        pts = (pts - T) @ R
+
+        # -S/2 < p < S/2 on every axis
+        mask = torch.all(pts.abs() < S/2, dim=-1)
         return mask
 
     @staticmethod
@@ -9,7 +9,7 @@ try:
 except ImportError:
     assert False, "clip is not installed, install it with `pip install clip`"
 
-from l3gos.encoders.image_encoder import BaseImageEncoder, BaseImageEncoderConfig
+from l3gos.encoders.image_encoder import BaseImageEncoder, BaseImageEncoderConfig, positive_relevancies
 
 
 @dataclass
@@ -41,6 +41,8 @@ class CLIPNetwork(BaseImageEncoder):
 
         self.positives = ["hand sanitizer"]
         self.negatives = self.config.negatives
+        # dtype -> (key, phrases_embeds, pos_embeds, neg_embeds), see get_phrases_embeds
+        self._phrases_cache = {}
         with torch.no_grad():
             tok_phrases = torch.cat([self.tokenizer(phrase) for phrase in self.positives]).to("cuda")
             self.pos_embeds = model.encode_text(tok_phrases)
@@ -71,13 +73,25 @@ class CLIPNetwork(BaseImageEncoder):
             self.pos_embeds = self.model.encode_text(tok_phrases)
         self.pos_embeds /= self.pos_embeds.norm(dim=-1, keepdim=True)
 
+    def get_phrases_embeds(self, dtype: torch.dtype) -> torch.Tensor:
+        """
+        positive and negative embeddings concatenated and cast to dtype, cached per dtype until the positives change
+        since relevancy is queried for every scale of every viewer frame
+        """
+        # the cache keeps both embeddings alive, so their ids can't be reused while it's valid
+        key = (id(self.pos_embeds), self.pos_embeds._version, id(self.neg_embeds), self.neg_embeds._version)
+        cache = self._phrases_cache.get(dtype)
+        if cache is None or cache[0] != key:
+            phrases_embeds = torch.cat([self.pos_embeds, self.neg_embeds], dim=0)
+            cache = self._phrases_cache[dtype] = (key, phrases_embeds.to(dtype), self.pos_embeds, self.neg_embeds)
+        return cache[1]
+
     def get_relevancy(self, embed: torch.Tensor, positive_id: int) -> torch.Tensor:
-        phrases_embeds = torch.cat([self.pos_embeds, self.neg_embeds], dim=0)
-        p = phrases_embeds.to(embed.dtype)  # phrases x 512
+        p = self.get_phrases_embeds(embed.dtype)  # phrases x 512
         output = torch.mm(embed, p.T)  # rays x phrases
         positive_vals = output[..., positive_id : positive_id + 1]  # rays x 1
         negative_vals = output[..., len(self.positives) :]  # rays x N_phrase
-        repeated_pos = positive_vals.repeat(1, len(self.negatives))  # rays x N_phrase
+        repeated_pos = positive_vals.expand(-1, len(self.negatives))  # rays x N_phrase, view since stack copies anyway
 
         sims = torch.stack((repeated_pos, negative_vals), dim=-1)  # rays x N-phrase x 2
         softmax = torch.softmax(10 * sims, dim=-1)  # rays x n-phrase x 2
@@ -86,6 +100,13 @@ class CLIPNetwork(BaseImageEncoder):
             :, 0, :
         ]
 
+    def get_positive_relevancies(self, embed: torch.Tensor) -> torch.Tensor:
+        # same as get_relevancy's positive column for every positive, from a single matmul against all phrases.
+        # The GEMM is float32 whatever embed's dtype, 10 * (pos - max neg) would amplify half precision rounding
+        p = self.get_phrases_embeds(torch.float32)  # phrases x 512
+        output = torch.mm(embed.to(torch.float32), p.T)  # rays x phrases
+        return positive_relevancies(output, len(self.positives))
+
     def encode_image(self, input):
         processed_input = self.process(input).half()
         return self.model.encode_image(processed_input)
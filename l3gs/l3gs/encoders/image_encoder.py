@@ -7,6 +7,19 @@ from nerfstudio.configs import base_config as cfg
 from torch import nn
 
 
+@torch.compile(dynamic=True)
+def positive_relevancies(output: torch.Tensor, n_positives: int) -> torch.Tensor:
+    """
+    Given the rays x phrases similarities (positives first, then negatives), return every positive's relevancy.
+    The softmax of a positive against its hardest negative is sigmoid(10 * (pos - max neg)), compiled so the
+    reduction, subtract and sigmoid are one kernel after the matmul. Returned in float32
+    """
+    output = output.to(torch.float32)
+    positive_vals = output[..., :n_positives]  # rays x N_positives
+    negative_vals = output[..., n_positives:]  # rays x N_phrase
+    return torch.sigmoid(10 * (positive_vals - negative_vals.amax(dim=-1, keepdim=True)))
+
+
 @dataclass
 class BaseImageEncoderConfig(cfg.InstantiateConfig):
     _target: Type = field(default_factory=lambda: BaseImageEncoder)
@@ -36,3 +49,17 @@ class BaseImageEncoder(nn.Module):
         """
         Given a batch of embeddings, return the relevancy to the given positive id
         """
+
+    @abstractmethod
+    def get_phrases_embeds(self, dtype: torch.dtype) -> torch.Tensor:
+        """
+        returns the positive then negative phrase embeddings as one phrases x embedding_dim matrix of the given dtype.
+        The same tensor is returned until the phrases change
+        """
+
+    @abstractmethod
+    def get_positive_relevancies(self, embed: torch.Tensor) -> torch.Tensor:
+        """
+        Given a batch of embeddings, return the relevancy (probability of the positive) to every positive at once,
+        rays x n_positives. The similarities are computed in float32 whatever the dtype of embed
+        """
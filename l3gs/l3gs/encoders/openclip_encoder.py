@@ -10,7 +10,8 @@ except ImportError:
     assert False, "open_clip is not installed, install it with `pip install open-clip-torch`"
 
 from l3gs.encoders.image_encoder import (BaseImageEncoder,
-                                         BaseImageEncoderConfig)
+                                         BaseImageEncoderConfig,
+                                         positive_relevancies)
 from nerfstudio.viewer.viewer_elements import ViewerText
 
 
@@ -58,6 +59,8 @@ class OpenCLIPNetwork(BaseImageEncoder):
 
         self.positives = self.positive_input.value.split(";")
         self.negatives = self.config.negatives
+        # dtype -> (key, phrases_embeds, pos_embeds, neg_embeds), see get_phrases_embeds
+        self._phrases_cache = {}
         with torch.no_grad():
             tok_phrases = torch.cat([self.tokenizer(phrase) for phrase in self.positives]).to(self.config.device)
             self.pos_embeds = model.encode_text(tok_phrases)
@@ -93,14 +96,26 @@ class OpenCLIPNetwork(BaseImageEncoder):
         self.pos_embeds /= self.pos_embeds.norm(dim=-1, keepdim=True)
         self.pos_embeds = self.pos_embeds.to(self.config.device)
 
+    def get_phrases_embeds(self, dtype: torch.dtype) -> torch.Tensor:
+        """
+        positive and negative embeddings concatenated and cast to dtype, cached per dtype until the positives change
+        since relevancy is queried for every scale of every viewer frame
+        """
+        # the cache keeps both embeddings alive, so their ids can't be reused while it's valid
+        key = (id(self.pos_embeds), self.pos_embeds._version, id(self.neg_embeds), self.neg_embeds._version)
+        cache = self._phrases_cache.get(dtype)
+        if cache is None or cache[0] != key:
+            phrases_embeds = torch.cat([self.pos_embeds, self.neg_embeds], dim=0).to(self.config.device)
+            cache = self._phrases_cache[dtype] = (key, phrases_embeds.to(dtype), self.pos_embeds, self.neg_embeds)
+        return cache[1]
+
     def get_relevancy(self, embed: torch.Tensor, positive_id: int) -> torch.Tensor:
-        phrases_embeds = torch.cat([self.pos_embeds, self.neg_embeds], dim=0).to(self.config.device)
-        p = phrases_embeds.to(embed.dtype)  # phrases x 512
+        p = self.get_phrases_embeds(embed.dtype)  # phrases x 512
         embed = embed.to(p.device)
         output = torch.mm(embed, p.T)  # rays x phrases
         positive_vals = output[..., positive_id : positive_id + 1]  # rays x 1
         negative_vals = output[..., len(self.positives) :]  # rays x N_phrase
-        repeated_pos = positive_vals.repeat(1, len(self.negatives))  # rays x N_phrase
+        repeated_pos = positive_vals.expand(-1, len(self.negatives))  # rays x N_phrase, view since stack copies anyway
 
         sims = torch.stack((repeated_pos, negative_vals), dim=-1)  # rays x N-phrase x 2
         softmax = torch.softmax(10 * sims, dim=-1)  # rays x n-phrase x 2
@@ -109,6 +124,14 @@ class OpenCLIPNetwork(BaseImageEncoder):
             :, 0, :
         ]
 
+    def get_positive_relevancies(self, embed: torch.Tensor) -> torch.Tensor:
+        # same as get_relevancy's positive column for every positive, from a single matmul against all phrases.
+        # The GEMM is float32 whatever embed's dtype, 10 * (pos - max neg) would amplify half precision rounding
+        p = self.get_phrases_embeds(torch.float32)  # phrases x 512
+        embed = embed.to(p.device, torch.float32)
+        output = torch.mm(embed, p.T)  # rays x phrases
+        return positive_relevancies(output, len(self.positives))
+
     def encode_image(self, input):
         processed_input = self.process(input).half()
         return self.model.encode_image(processed_input)
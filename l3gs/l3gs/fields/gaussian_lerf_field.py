@@ -47,6 +47,16 @@ except ImportError:
     pass
 
 
+@torch.compile(dynamic=True)
+def normalize_clip(clip_pass: Tensor, dtype: torch.dtype = torch.float32) -> Tensor:
+    """
+    Unit-normalizes the clip head output (in float32) and casts it to dtype, compiled so the norm, divide and cast
+    run as one fused pass instead of three over the (N, 512) output
+    """
+    clip_pass = clip_pass.to(torch.float32)
+    return (clip_pass / clip_pass.norm(dim=-1, keepdim=True)).to(dtype)
+
+
 class GaussianLERFField(Field):
     """Compound Field that uses TCNN
 
@@ -193,7 +203,7 @@ class GaussianLERFField(Field):
        
         # encoding = self.mlp_base_grid(positions.view(-1, 3))
         # clip_pass = self.clip_net(torch.cat([encoding, clip_scales.view(-1, 1)], dim=-1))
-        outputs[GaussianLERFFieldHeadNames.CLIP] = (clip_pass / clip_pass.norm(dim=-1, keepdim=True)).to(torch.float32)
+        outputs[GaussianLERFFieldHeadNames.CLIP] = normalize_clip(clip_pass)
 
         # dino_pass = self.dino_net(x).view(positions.shape[0], -1)
         # outputs[GaussianLERFFieldHeadNames.DINO] = dino_pass
@@ -211,16 +221,25 @@ class GaussianLERFField(Field):
         return encoding.to(torch.float32)
     
     def get_outputs_from_feature(self, clip_features, clip_scale) -> Dict[GaussianLERFFieldHeadNames, Tensor]:
-        outputs = {}
         # import pdb; pdb.set_trace()
         
         #clip_features is Nx32, and clip scale is a number, I want to cat clip scale to the end of clip_features where clip scale is an int
         # clip_pass = self.clip_feature_net(torch.cat([clip_features, clip_scale.view(-1, 1)], dim=-1))
-        clip_pass = self.clip_net(torch.cat([clip_features, clip_scale.view(-1, 1)], dim=-1))
+        return self.get_outputs_from_input(torch.cat([clip_features, clip_scale.view(-1, 1)], dim=-1))
+
+    def get_outputs_from_input(self, clip_input, dtype: torch.dtype = torch.float32) -> Dict[GaussianLERFFieldHeadNames, Tensor]:
+        """
+        Same as get_outputs_from_feature, but takes the clip features with the clip scale already appended as the
+        last column, so callers sweeping scales over the same features can fill one buffer instead of
+        concatenating a new one per scale. dtype is the dtype of the returned (unit norm) clip features, the
+        clip net itself runs in half precision either way
+        """
+        outputs = {}
+        clip_pass = self.clip_net(clip_input)
 
         # print("Max scale: ", clip_scale.max(), "Mean scale: ", clip_scale.mean(), "Min scale: ", clip_scale.min())
         # clip_pass = self.clip_feature_net(clip_features)
-        outputs[GaussianLERFFieldHeadNames.CLIP] = (clip_pass / clip_pass.norm(dim=-1, keepdim=True)).to(torch.float32)
+        outputs[GaussianLERFFieldHeadNames.CLIP] = normalize_clip(clip_pass, dtype)
 
         # dino_pass = self.dino_net(clip_features).view(clip_features.shape[0], -1)
         # outputs[GaussianLERFFieldHeadNames.DINO] = dino_pass
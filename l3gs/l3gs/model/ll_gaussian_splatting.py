@@ -19,19 +19,29 @@ NeRF implementation that combines many recent advancements.
 
 from __future__ import annotations
 
+import collections
+import contextlib
+import functools
 import math
+import os
 from dataclasses import dataclass, field
-from typing import Dict, List, Optional, Tuple, Type, Union
+from typing import Dict, Iterator, List, Optional, Tuple, Type, Union
 
 import numpy as np
 import torch
-from gsplat.cuda_legacy._torch_impl import quat_to_rotmat
+import torch.nn.functional as F
 
 try:
     from gsplat.rendering import rasterization
 except ImportError:
     print("Please install gsplat>=1.0.0")
 from gsplat.cuda_legacy._wrapper import num_sh_bases
+
+try:
+    # optional, lets k_nearest_torch reduce over all points without ever materializing a distance block
+    from pykeops.torch import LazyTensor
+except ImportError:
+    LazyTensor = None
 from pytorch_msssim import SSIM
 from torch.nn import Parameter
 from typing_extensions import Literal
@@ -58,39 +68,56 @@ from nerfstudio.viewer.viewer import VISER_NERFSTUDIO_SCALE_RATIO
 from nerfstudio.utils.colormaps import apply_colormap
 import viser.transforms as vtf
 
+# Let the caching allocator grow segments in place as gaussians are added and culled instead of fragmenting, so
+# densification doesn't need empty_cache. The allocator only reads this on CUDA init, and torch<2.1 rejects it.
+TORCH_2_1 = tuple(int(v) for v in torch.__version__.split(".")[:2]) >= (2, 1)
+if TORCH_2_1:
+    os.environ.setdefault("PYTORCH_CUDA_ALLOC_CONF", "expandable_segments:True")
+
 
-def random_quat_tensor(N):
+def random_quat_tensor(N, device: Union[str, torch.device] = "cpu"):
     """
-    Defines a random quaternion tensor of shape (N, 4)
+    Defines a random quaternion tensor of shape (N, 4), sampled directly on device
     """
-    u = torch.rand(N)
-    v = torch.rand(N)
-    w = torch.rand(N)
-    return torch.stack(
-        [
-            torch.sqrt(1 - u) * torch.sin(2 * math.pi * v),
-            torch.sqrt(1 - u) * torch.cos(2 * math.pi * v),
-            torch.sqrt(u) * torch.sin(2 * math.pi * w),
-            torch.sqrt(u) * torch.cos(2 * math.pi * w),
-        ],
-        dim=-1,
-    )
+    uvw = torch.rand((N, 3), device=device)
+    # both angles go through one sin and one cos, written straight into the interleaved output columns
+    angles = uvw[:, 1:].mul(2 * math.pi)
+    quats = torch.empty((N, 4), device=device)
+    torch.sin(angles, out=quats[:, 0::2])
+    torch.cos(angles, out=quats[:, 1::2])
+    # then scale the (sin a, cos a) pair by sqrt(1 - u) and the (sin b, cos b) pair by sqrt(u)
+    radii = torch.stack([1 - uvw[:, 0], uvw[:, 0]], dim=-1).sqrt_()
+    quats.view(N, 2, 2).mul_(radii[:, :, None])
+    return quats
+
+
+# split gaussians (and their samples) shrink by this factor, kept in log space to match the scale parameters
+LOG_SPLIT_SIZE_FAC = math.log(1.6)
+
+# 0th order real spherical harmonic, 1 / (2 * sqrt(pi))
+SH_C0 = 0.28209479177387814
+INV_SH_C0 = 1.0 / SH_C0
 
 
 def RGB2SH(rgb):
     """
     Converts from RGB values [0,1] to the 0th spherical harmonic coefficient
     """
-    C0 = 0.28209479177387814
-    return (rgb - 0.5) / C0
+    return (rgb - 0.5) * INV_SH_C0
+
+
+def RGB2SH_(rgb):
+    """
+    In place version of RGB2SH, overwrites rgb with the 0th spherical harmonic coefficient
+    """
+    return rgb.sub_(0.5).mul_(INV_SH_C0)
 
 
 def SH2RGB(sh):
     """
     Converts from the 0th spherical harmonic coefficient to RGB values [0,1]
     """
-    C0 = 0.28209479177387814
-    return sh * C0 + 0.5
+    return sh * SH_C0 + 0.5
 
 
 def resize_image(image: torch.Tensor, d: int):
@@ -102,31 +129,149 @@ def resize_image(image: torch.Tensor, d: int):
 
     return downscaled image in shape [H//d, W//d, C]
     """
-    import torch.nn.functional as tf
-
     image = image.to(torch.float32)
-    weight = (1.0 / (d * d)) * torch.ones((1, 1, d, d), dtype=torch.float32, device=image.device)
-    return tf.conv2d(image.permute(2, 0, 1)[:, None, ...], weight, stride=d).squeeze(1).permute(1, 2, 0)
+    # a box filter is an average pool, no weight tensor to build. An [H, W, C] image permuted to [1, C, H, W] already
+    # has channels last strides, so the pooling runs on the NHWC kernel without a layout copy either way
+    return F.avg_pool2d(image.permute(2, 0, 1)[None], kernel_size=d, stride=d)[0].permute(1, 2, 0)
+
+
+@functools.lru_cache(maxsize=16)
+def intrinsics_matrix(fx: float, fy: float, cx: float, cy: float, device: torch.device) -> torch.Tensor:
+    """
+    Builds the [1, 3, 3] pinhole intrinsics matrix gsplat expects. Cached since the intrinsics rarely change
+    between frames, so repeated cameras cost no kernel launches or host to device copies
+    """
+    return torch.tensor([[[fx, 0.0, cx], [0.0, fy, cy], [0.0, 0.0, 1.0]]], device=device)
 
 
-@torch.compile()
+@torch.jit.script
 def get_viewmat(optimized_camera_to_world):
     """
-    function that converts c2w to gsplat world2camera matrix, using compile for some speed
+    function that converts c2w to gsplat world2camera matrix. Scripted rather than compiled: it runs on a tiny
+    [B, 4, 4] every step, where dynamo's guards and cold start compile cost more than the fusion buys. Written
+    without in-place writes or constant tensors so the scripted graph is a single fusible chain
     """
     R = optimized_camera_to_world[:, :3, :3]  # 3 x 3
     T = optimized_camera_to_world[:, :3, 3:4]  # 3 x 1
-    # flip the z and y axes to align with gsplat conventions
-    R = R * torch.tensor([[[1, -1, -1]]], device=R.device, dtype=R.dtype)
-    # analytic matrix inverse to get world2camera matrix
+    # analytic matrix inverse to get world2camera matrix, flipping the z and y axes (columns of R, so rows of
+    # R_inv) to align with gsplat conventions
     R_inv = R.transpose(1, 2)
+    R_inv = torch.cat([R_inv[:, :1], -R_inv[:, 1:]], dim=1)
     T_inv = -torch.bmm(R_inv, T)
-    viewmat = torch.zeros(R.shape[0], 4, 4, device=R.device, dtype=R.dtype)
-    viewmat[:, 3, 3] = 1.0  # homogenous
-    viewmat[:, :3, :3] = R_inv
-    viewmat[:, :3, 3:4] = T_inv
-    return viewmat
+    top = torch.cat([R_inv, T_inv], dim=2)  # B x 3 x 4
+    bottom = F.pad(torch.ones_like(top[:, :1, :1]), [3, 0])  # B x 1 x 4, [0, 0, 0, 1] homogenous
+    return torch.cat([top, bottom], dim=1)
+
+
+@torch.compile(dynamic=True)
+def activate_gaussians(scales, opacities, features_dc, features_rest):
+    """
+    Pre-rasterization activations, compiled so the elementwise passes over the gaussians fuse into a few kernels.
+    dynamic since the number of gaussians changes with every add/densify/cull
+    """
+    colors = torch.cat((features_dc[:, None, :], features_rest), dim=1)
+    return torch.exp(scales), torch.sigmoid(opacities).squeeze(-1), colors
+
 
+@torch.compile(dynamic=True)
+def finalize_render(render, alpha, background, with_depth: bool):
+    """
+    Composites the rasterized rgb over the background and, if with_depth, fills the depth of empty pixels with
+    the max depth (kept on the device, no readback). Compiled so the blend, clamp and fill are fused passes
+    over the image instead of a kernel each
+    """
+    rgb = torch.clamp(render[..., :3] + (1 - alpha) * background, 0.0, 1.0)
+    if not with_depth:
+        return rgb, None
+    depth_im = render[..., 3:4]
+    return rgb, torch.where(alpha > 0, depth_im, depth_im.detach().amax())
+
+
+@torch.compile(dynamic=True)
+def l1_loss(gt_img, pred_img):
+    """mean absolute error, compiled into a single reduction without materializing |gt - pred|"""
+    return torch.abs(gt_img - pred_img).mean()
+
+
+@torch.compile(dynamic=True)
+def clip_huber_loss(pred, gt, weight: float):
+    """
+    Per-pixel huber loss summed over the clip dims and averaged over pixels, compiled so the unreduced
+    (N, 512) loss isn't written out before the reductions
+    """
+    unreduced = weight * torch.nn.functional.huber_loss(pred, gt.to(torch.float32), delta=1.25, reduction="none")
+    return unreduced.sum(dim=-1).nanmean()
+
+
+@torch.compile(dynamic=True)
+def scale_ratio_loss(scales, max_gauss_ratio: float):
+    """PhysGaussian scale regularization on log scales, max/min of exp(scales) is exp(amax - amin)"""
+    ratio = torch.exp(scales.amax(dim=-1) - scales.amin(dim=-1))
+    return 0.1 * (ratio.clamp_min(max_gauss_ratio) - max_gauss_ratio).mean()
+
+
+@torch.compile(dynamic=True)
+def knn_blend(neighbour_feats, neighbour_opacities):
+    """
+    Opacity weighted average over the k nearest neighbours, neighbour_feats is (N, k, D) and
+    neighbour_opacities is (N, k). Compiled so sigmoid -> softmax -> multiply -> sum is one pass over the feats
+    """
+    weights = F.softmax(torch.sigmoid(neighbour_opacities), dim=-1)
+    return (neighbour_feats * weights.unsqueeze(-1)).sum(dim=1)
+
+
+@torch.compile(dynamic=True)
+def accumulate_grad_stats(absgrad, radii, grad_norm, vis_counts):
+    """
+    Adds the screen space grad norms of the visible gaussians into grad_norm and counts them in vis_counts, both
+    in place. Compiled so the norm, visibility test and both accumulations are one pass over the gaussians
+    """
+    visible = (radii > 0).flatten()
+    vis_counts.add_(visible)
+    grad_norm.add_(torch.where(visible, absgrad.norm(dim=-1), 0.0))
+
+
+def cull_predicate(opacities, scales, extra: Optional[torch.Tensor], logit_alpha: float, log_scale: float, check_big: bool):
+    """
+    Mask of the gaussians to cull, plus the number culled for low opacity and for being too big, stacked so they're
+    read back together. Thresholds are in the raw parameter space (logit / log) so there are no activations. Left
+    eager, it only runs once per refinement and compiling its variants would cost more than the kernels it saves
+    """
+    below = opacities.squeeze(-1) < logit_alpha
+    culls = below
+    if extra is not None:
+        culls = culls | extra
+    if check_big:
+        toobigs = scales.amax(dim=-1) > log_scale
+        culls = culls | toobigs
+        n_toobig = toobigs.sum()
+    else:
+        n_toobig = torch.zeros_like(below.sum())
+    return culls, torch.stack([below.sum(), n_toobig])
+
+
+def rotate_by_quats(quats, v):
+    """
+    Rotates the vectors v (..., N, 3) by the unit wxyz quaternions quats (N, 4), broadcast over the leading dims of v.
+    Uses v' = v + w t + xyz x t with t = 2 xyz x v, so no rotation matrices are built
+    """
+    w, xyz = quats[..., :1], quats[..., 1:].expand_as(v)
+    t = 2 * torch.linalg.cross(xyz, v)
+    return v + w * t + torch.linalg.cross(xyz, t)
+
+
+# dtype of the decoded clip features in the viewer's relevancy sweep, the relevancy GEMM itself stays float32
+RELEVANCY_DTYPE = torch.float16
+
+
+def _clone_gauss_state_dict(module, state_dict, prefix, local_metadata):
+    """
+    gauss_params are views into over-allocated storage (see append_gaussians), clone them on save so
+    checkpoints don't serialize the unused capacity
+    """
+    for name in module.keys():
+        if prefix + name in state_dict:
+            state_dict[prefix + name] = state_dict[prefix + name].clone()
 
 
 @dataclass
@@ -170,6 +315,12 @@ class LLGaussianSplattingModelConfig(SplatfactoModelConfig):
     """Number of gaussians to initialize if random init is used"""
     random_scale: float = 100.0
     "Size of the cube to initialize random gaussians within"
+    init_scale_mode: Literal["knn", "analytic", "constant"] = "knn"
+    """
+    How the initial gaussian scales are picked. knn uses the mean distance to the 3 nearest neighbours, analytic uses
+    the expected point spacing of the random init cube (random_scale / num_random^(1/3)) and skips the kNN, falling
+    back to knn for seed points, and constant uses the same 0.02 as deprojected points.
+    """
     init_opacity: float = 0.2
     """Initial opacity of deprojected gaussians"""
     ssim_lambda: float = 0.2
@@ -186,8 +337,11 @@ class LLGaussianSplattingModelConfig(SplatfactoModelConfig):
     """threshold of ratio of gaussian max to min scale before applying regularization
     loss from the PhysGaussian paper
     """
-    output_depth_during_training: bool = True
-    """If True, output depth during training. Otherwise, only output depth during evaluation."""
+    output_depth_during_training: bool = False
+    """
+    If True, output depth during training. Otherwise depth is only rendered during evaluation and on the training
+    steps that supervise the CLIP field, which need it for the clip scale.
+    """
     rasterize_mode: Literal["classic", "antialiased"] = "classic"
     """
     Classic mode of rendering will use the EWA volume splatting with a [0.3, 0.3] screen space blurring kernel. This
@@ -200,6 +354,13 @@ class LLGaussianSplattingModelConfig(SplatfactoModelConfig):
     """
     camera_optimizer: CameraOptimizerConfig = field(default_factory=lambda: CameraOptimizerConfig(mode="off"))
     """Config of the camera optimizer to use"""
+    relevancy_cuda_graph: bool = True
+    """
+    If True, the per-scale clip net and relevancy sweep of the viewer's relevancy maps is captured into a CUDA graph
+    per render size once that size repeats, and replayed while the phrases stay the same. Falls back to eager if
+    capture fails. Needs torch>=2.1: the viewer captures while training runs on another thread, which only a
+    thread local capture allows.
+    """
 
 
 class LLGaussianSplattingModel(SplatfactoModel):
@@ -223,6 +384,8 @@ class LLGaussianSplattingModel(SplatfactoModel):
         self.colors_new = []
         self.postBA = False
         self.localized_query = None
+        self.random_pixels = None
+        self._random_pixels_src = None
 
     def populate_modules(self):
         if self.seed_points is not None and not self.config.random_init:
@@ -230,13 +393,20 @@ class LLGaussianSplattingModel(SplatfactoModel):
         else:
             means = torch.nn.Parameter((torch.rand((self.config.num_random, 3)) - 0.5) * self.config.random_scale)
         self.xys_grad_norm = None
-        distances, _ = self.k_nearest_sklearn(means.data, 3)
-        distances = torch.from_numpy(distances)
-        # find the average of the three nearest neighbors for each point and use that as the scale
-        avg_dist = distances.mean(dim=-1, keepdim=True)/5.0
-        scales = torch.nn.Parameter(torch.log(avg_dist.repeat(1, 3)))
         num_points = means.shape[0]
-        quats = torch.nn.Parameter(random_quat_tensor(num_points))
+        random_points = self.seed_points is None or self.config.random_init
+        if self.config.init_scale_mode == "constant":
+            scales = torch.nn.Parameter(torch.full((num_points, 3), math.log(0.02)))
+        elif self.config.init_scale_mode == "analytic" and random_points:
+            # uniform points in a cube are random_scale / num^(1/3) apart on average, no need to search for neighbours
+            spacing = self.config.random_scale / max(num_points, 1) ** (1 / 3)
+            scales = torch.nn.Parameter(torch.full((num_points, 3), math.log(spacing / 5.0)))
+        else:
+            distances, _ = self.k_nearest_torch(means.data, 3)
+            # find the average of the three nearest neighbors for each point and use that as the scale
+            avg_dist = distances.mean(dim=-1, keepdim=True)/5.0
+            scales = torch.nn.Parameter(torch.log(avg_dist.repeat(1, 3)))
+        quats = torch.nn.Parameter(random_quat_tensor(num_points, device=means.device))
         dim_sh = num_sh_bases(self.config.sh_degree)
 
         self.gaussian_lerf_field = GaussianLERFField()
@@ -262,7 +432,8 @@ class LLGaussianSplattingModel(SplatfactoModel):
             features_dc = torch.nn.Parameter(torch.rand(num_points, 3))
             features_rest = torch.nn.Parameter(torch.zeros((num_points, dim_sh - 1, 3)))
 
-        opacities = torch.nn.Parameter(torch.logit(0.1 * torch.ones(num_points, 1)))
+        # every gaussian starts at opacity 0.1, fill logit(0.1) directly instead of taking the logit of a ones tensor
+        opacities = torch.nn.Parameter(torch.full((num_points, 1), math.log(0.1 / (1 - 0.1))))
         self.gauss_params = torch.nn.ParameterDict(
             {
                 "means": means,
@@ -273,6 +444,37 @@ class LLGaussianSplattingModel(SplatfactoModel):
                 "opacities": opacities,
             }
         )
+        # capacity-doubling backing storage for gauss_params, see append_gaussians
+        self._gauss_storage: Dict[str, torch.Tensor] = {}
+        self._optim_storage: Dict[Tuple[str, str], torch.Tensor] = {}
+        self.gauss_params._register_state_dict_hook(_clone_gauss_state_dict)
+        self._quats_norm_cache = None
+        self._activations_cache = None
+        self._clip_hash_cache = None
+        self._gt_cache = None
+        self._knn_cache = None
+        self._knn_hash_cache = None
+        self._param_groups_cache = None
+        # training background, refilled in place every step instead of allocating a new tensor per forward
+        self.register_buffer("_bg_buf", torch.empty(3), persistent=False)
+        # clip scales swept by get_max_across, fixed so built once and moved with the model
+        self.register_buffer("_scales_list", torch.linspace(0.0, 1.5, 30), persistent=False)
+        # side stream for adam moment maintenance, created on first use since we're still on cpu here
+        self._maint_stream: Optional[torch.cuda.Stream] = None
+        self._maint_event: Optional[torch.cuda.Event] = None
+        # side stream prefetch_clip_hash runs the hash grid on, also created on first use
+        self._hash_stream: Optional[torch.cuda.Stream] = None
+        self._logit_init_opacity = math.log(self.config.init_opacity / (1 - self.config.init_opacity))
+        self._logit_cull_alpha = math.log(self.config.cull_alpha_thresh / (1 - self.config.cull_alpha_thresh))
+        # opacity resets clamp to twice the cull threshold
+        reset_value = self.config.cull_alpha_thresh * 2.0
+        self._logit_reset_alpha = math.log(reset_value / (1 - reset_value))
+        # captured relevancy sweeps by key, LRU ordered, each (graph, static clip input, static outputs). None marks a
+        # key seen once, which runs eagerly. All of them are for _relevancy_graph_phrases
+        self._relevancy_graphs: collections.OrderedDict = collections.OrderedDict()
+        self._relevancy_graph_phrases = None
+        # set if a capture fails, the sweep then stays eager for the rest of the run
+        self._relevancy_graph_failed = False
 
         self.camera_optimizer: CameraOptimizer = self.config.camera_optimizer.setup(
             num_cameras=self.num_train_data, device="cpu"
@@ -289,11 +491,13 @@ class LLGaussianSplattingModel(SplatfactoModel):
 
         self.crop_box: Optional[OrientedBox] = None
         if self.config.background_color == "random":
-            self.background_color = torch.tensor(
+            background_color = torch.tensor(
                 [0.1490, 0.1647, 0.2157]
             )  # This color is the same as the default background color in Viser. This would only affect the background color when rendering.
         else:
-            self.background_color = get_color(self.config.background_color)
+            background_color = get_color(self.config.background_color)
+        # a buffer so it moves to the gpu with the model, rather than being copied over on every render
+        self.register_buffer("background_color", background_color, persistent=False)
 
         #l3gs init
         self.steps_since_add = 0
@@ -347,6 +551,79 @@ class LLGaussianSplattingModel(SplatfactoModel):
     def opacities(self):
         return self.gauss_params["opacities"]
 
+    def normalized_quats(self) -> torch.Tensor:
+        """
+        Unit quaternions for every gaussian. Outside of autograd (viewer renders) the result is cached until
+        quats is stepped, resized or reassigned.
+        """
+        if torch.is_grad_enabled():
+            return F.normalize(self.quats, dim=-1)
+        key = (self.quats._version, self.quats.data_ptr(), self.quats.shape[0])
+        if self._quats_norm_cache is None or self._quats_norm_cache[0] != key:
+            self._quats_norm_cache = (key, F.normalize(self.quats.detach(), dim=-1))
+        return self._quats_norm_cache[1]
+
+    def activated_gaussians(self, sh_degree: Optional[int] = None) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+        """
+        exp(scales), sigmoid(opacities) and the concatenated SH coefficients for every gaussian, see
+        activate_gaussians. Like normalized_quats, outside of autograd the result is cached until any of the inputs
+        is stepped, resized or reassigned.
+        sh_degree: only the coefficients up to this degree are gathered, the rasterizer never reads the higher
+            ones and features_rest is most of the bytes per gaussian. None keeps all of them
+        """
+        features_rest = self.features_rest
+        if sh_degree is not None:
+            features_rest = features_rest[:, : num_sh_bases(sh_degree) - 1]
+        params = (self.scales, self.opacities, self.features_dc, features_rest)
+        if torch.is_grad_enabled():
+            return activate_gaussians(*params)
+        key = tuple((p._version, p.data_ptr(), p.shape[0]) for p in params) + (sh_degree,)
+        if self._activations_cache is None or self._activations_cache[0] != key:
+            self._activations_cache = (key, activate_gaussians(*(p.detach() for p in params)))
+        return self._activations_cache[1]
+
+    def clip_hash(self) -> torch.Tensor:
+        """
+        gaussian_lerf_field.get_hash(self.means). Like normalized_quats, outside of autograd the result is cached,
+        until the means or any of the lerf field's weights are stepped, resized or reassigned.
+        """
+        if torch.is_grad_enabled():
+            return self.gaussian_lerf_field.get_hash(self.means)
+        key = self._clip_hash_key()
+        cache = self._clip_hash_cache
+        if cache is None or cache[0] != key:
+            cache = self._clip_hash_cache = (key, self.gaussian_lerf_field.get_hash(self.means.detach()), None)
+        if cache[2] is not None:
+            # computed by prefetch_clip_hash on the side stream, wait for it (on the gpu, no host sync)
+            torch.cuda.current_stream(self.device).wait_event(cache[2])
+            cache = self._clip_hash_cache = cache[:2] + (None,)
+        return cache[1]
+
+    def _clip_hash_key(self):
+        params = (self.means, *self.gaussian_lerf_field.parameters())
+        return tuple((p._version, p.data_ptr(), p.numel()) for p in params)
+
+    @torch.no_grad()
+    def prefetch_clip_hash(self):
+        """
+        Starts computing clip_hash() on a side stream if the cached one is stale, so the hash grid overlaps
+        whatever is queued next on the current stream (the RGB rasterization). clip_hash() waits for it on use
+        """
+        if self.device.type != "cuda":
+            return
+        key = self._clip_hash_key()
+        if self._clip_hash_cache is not None and self._clip_hash_cache[0] == key:
+            return
+        if self._hash_stream is None:
+            self._hash_stream = torch.cuda.Stream(device=self.device)
+        current = torch.cuda.current_stream(self.device)
+        self._hash_stream.wait_stream(current)
+        with torch.cuda.stream(self._hash_stream):
+            clip_hash = self.gaussian_lerf_field.get_hash(self.means.detach())
+        # allocated on the side stream but consumed (and eventually freed) on the current one
+        clip_hash.record_stream(current)
+        self._clip_hash_cache = (key, clip_hash, self._hash_stream.record_event())
+
     def load_state_dict(self, dict, **kwargs):  # type: ignore
         # resize the parameters to match the new number of points
         self.step = 30000
@@ -356,210 +633,309 @@ class LLGaussianSplattingModel(SplatfactoModel):
             for p in ["means", "scales", "quats", "features_dc", "features_rest", "opacities"]:
                 dict[f"gauss_params.{p}"] = dict[p]
         newp = dict["gauss_params.means"].shape[0]
+        # resized in place like append_gaussians, so the Parameter objects (and anything keyed on them, such as
+        # optimizer state) survive the load. Left uninitialized since load_state_dict overwrites every element
+        for param in self.gauss_params.values():
+            new_shape = (newp,) + param.shape[1:]
+            param.data = torch.empty(new_shape, device=self.device, dtype=param.dtype)
+            param.grad = None
+        self._gauss_storage.clear()
+        self._optim_storage.clear()
+        # skip SplatfactoModel.load_state_dict, it would replace every gauss_param with a new zeroed Parameter. The
+        # plain Module load copies into the resized Parameters, so get_param_groups and the optimizers stay live
+        super(SplatfactoModel, self).load_state_dict(dict, **kwargs)
+
+    def append_gaussians(self, new_params: Dict[str, Union[torch.Tensor, float]]):
+        """
+        Appends new gaussians to every parameter in gauss_params in place.
+        Each parameter is a view into a larger storage tensor whose capacity doubles when it runs out, so
+        appending only copies the new rows in the common case. The Parameter objects themselves are kept,
+        which keeps the optimizer's references to them valid.
+        new_params: mapping from gauss_params name to the rows to append, or a python scalar to fill them with.
+            Rows may also come in equal blocks with one extra leading dim, eg. an expanded (samps, N, ...) view,
+            which is copied without materializing it. The number of new gaussians is taken from "means", which
+            must be an unblocked tensor
+        """
+        n = self.num_points
+        num_new = new_params["means"].shape[0]
+        for name, param in self.gauss_params.items():
+            buf = self._gauss_storage.get(name)
+            if buf is None or buf.data_ptr() != param.data_ptr() or buf.shape[0] < n + num_new:
+                # training needs the memory more than the viewer, release the captured relevancy graphs' pools
+                self._relevancy_graphs.clear()
+                buf = param.data.new_empty((max(2 * n, n + num_new),) + param.shape[1:])
+                buf[:n] = param.data
+                self._gauss_storage[name] = buf
+            rows = buf[n : n + num_new]
+            value = new_params[name]
+            if isinstance(value, torch.Tensor) and value.dim() > rows.dim():
+                rows = rows.view(value.shape)
+            rows[...] = value
+            param.data = buf[: n + num_new]
+            param.grad = None
+
+    def keep_gaussians(self, keep: torch.Tensor):
+        """
+        Compacts every parameter in gauss_params down to the rows selected by keep, reusing the storage
+        allocated by append_gaussians.
+        keep: index tensor of the gaussians to keep, shared by all parameters
+        """
         for name, param in self.gauss_params.items():
-            old_shape = param.shape
-            new_shape = (newp,) + old_shape[1:]
-            self.gauss_params[name] = torch.nn.Parameter(torch.zeros(new_shape, device=self.device))
-        super().load_state_dict(dict, **kwargs)
+            kept = param.data.index_select(0, keep)
+            buf = self._gauss_storage.get(name)
+            if buf is not None and buf.data_ptr() == param.data_ptr():
+                buf[: kept.shape[0]] = kept
+                kept = buf[: kept.shape[0]]
+            else:
+                self._gauss_storage[name] = kept
+            param.data = kept
+            param.grad = None
 
-    def k_nearest_sklearn(self, x: torch.Tensor, k: int, include_self: bool = False):
+    def k_nearest_torch(self, x: torch.Tensor, k: int, include_self: bool = False, max_chunk_bytes: int = 256 * 2**20):
         """
-        Find k-nearest neighbors using sklearn's NearestNeighbors.
+        Find k-nearest neighbors on the device of x. With pykeops installed and x on the gpu this is a single fused
+        KeOps reduction in O(num_samples) memory, otherwise a brute force torch.cdist + topk over row chunks.
         x: The data tensor of shape [num_samples, num_features]
         k: The number of neighbors to retrieve
+        max_chunk_bytes: budget for the chunk x num_samples distance block of each cdist call, the number of query
+            rows per chunk shrinks as num_samples grows so the block (and topk's workspace, about as large) stays
+            within it on the gpu that's also training
         """
-        # Convert tensor to numpy array
-        x_np = x.cpu().numpy()
-
-        # Build the nearest neighbors model
-        from sklearn.neighbors import NearestNeighbors
-
-        nn_model = NearestNeighbors(n_neighbors=k + 1, algorithm="auto", metric="euclidean").fit(x_np)
-
-        # Find the k-nearest neighbors
-        distances, indices = nn_model.kneighbors(x_np)
+        n_neighbors = min(k + 1, x.shape[0])
+        if LazyTensor is not None and x.is_cuda:
+            x = x.contiguous()
+            sq_dists = ((LazyTensor(x[:, None, :]) - LazyTensor(x[None, :, :])) ** 2).sum(-1)
+            distances, indices = sq_dists.Kmin_argKmin(n_neighbors, dim=1)
+            # KeOps reduces over squared distances, cdist returns euclidean ones
+            distances = distances.clamp_min_(0.0).sqrt_()
+            indices = indices.long()
+            if include_self:
+                return distances, indices
+            else:
+                return distances[:, 1:], indices[:, 1:]
+
+        # each chunk's topk writes straight into its rows of the result, no per chunk outputs to concatenate
+        chunk_size = max(1, max_chunk_bytes // (x.element_size() * x.shape[0]))
+        distances = x.new_empty((x.shape[0], n_neighbors))
+        indices = torch.empty((x.shape[0], n_neighbors), dtype=torch.long, device=x.device)
+        for i in range(0, x.shape[0], chunk_size):
+            # cdist would otherwise switch to the |x|^2 - 2 x.y + |y|^2 matmul expansion past 25 rows, whose float32
+            # cancellation loses the small neighbour distances this is after
+            d = torch.cdist(x[i : i + chunk_size], x, compute_mode="donot_use_mm_for_euclid_dist")
+            torch.topk(d, n_neighbors, dim=-1, largest=False, out=(distances[i : i + chunk_size], indices[i : i + chunk_size]))
 
         if include_self:
-            return distances.astype(np.float32), indices
+            return distances, indices
         else:
-            return distances[:, 1:].astype(np.float32), indices[:, 1:].astype(np.float32)
-        
-    def add_new_params_to_optimizer(self, optimizer, new_param_groups):
-        """
-        Adds new parameters to the optimizer, initializing necessary states.
+            return distances[:, 1:], indices[:, 1:]
 
-        Args:
-            optimizer (torch.optim.Optimizer): The existing optimizer.
-            new_param_groups (dict): A dictionary of new parameters to add, categorized by group.
+    def means_knn(self, k: int) -> torch.Tensor:
         """
-        num_new = new_param_groups[0].shape[0]
-        
-        param = optimizer.param_groups[0]["params"][0]
+        Indices of each gaussian's k nearest neighbours, itself included (so [N, k + 1]). The viewer callbacks
+        query this repeatedly, so it's cached until the means are stepped, moved or resized
+        """
+        key = (k, self.means._version, self.means.data_ptr(), self.means.shape[0])
+        if self._knn_cache is None or self._knn_cache[0] != key:
+            _, indices = self.k_nearest_torch(self.means.data, k, True)
+            self._knn_cache = (key, indices)
+        return self._knn_cache[1]
 
-        param_state = optimizer.state[param]
-        
+    def knn_clip_hash(self) -> torch.Tensor:
+        """
+        clip_hash() averaged over each gaussian's 3 nearest neighbours (and itself), weighted by opacity, see
+        knn_blend. Shared by the viewer callbacks and cached like clip_hash, until the means, opacities or lerf
+        field change
+        """
+        key = self._clip_hash_key() + ((self.opacities._version, self.opacities.data_ptr()),)
+        if self._knn_hash_cache is None or self._knn_hash_cache[0] != key:
+            indicies = self.means_knn(3).view(-1)
+            # the hash is per point, so the neighbours' hashes are a gather from the (cached) per gaussian hash
+            clip_hash_encoding = self.clip_hash().index_select(0, indicies)
+            clip_hash_encoding = knn_blend(
+                clip_hash_encoding.view(-1, 4, clip_hash_encoding.shape[1]),
+                self.opacities.detach().index_select(0, indicies).view(-1, 4),
+            )
+            self._knn_hash_cache = (key, clip_hash_encoding)
+        return self._knn_hash_cache[1]
 
-        repeat_dims = (num_new,) + tuple(1 for _ in range(param_state["exp_avg"].dim() - 1))
+    def add_deprojected_means(self, deprojected, colors, optimizers: Optimizers, step):
+        # runs every iteration but the queue is almost always empty, bail out before touching autograd state
+        if len(deprojected) == 0:
+            return
+        with torch.no_grad():
+            # the trainer queues either whole (N, 3) point clouds or single (3,) points, flatten both into
+            # one batch so all pending points are added with a single append
+            deprojected = torch.cat([d.view(-1, 3) for d in deprojected], dim=0).to(self.device, non_blocking=True)
+            colors = torch.cat([c.view(-1, 3) for c in colors], dim=0).to(self.device, torch.float32, non_blocking=True)
+            numpts = len(deprojected)
+
+            # if self.clrs == None:
+            #     self.clrs = torch.nn.Parameter(torch.cat([self.means.detach(), colors], dim=0))
+            # else:
+            #     self.clrs = torch.nn.Parameter(torch.cat([self.clrs.detach(), colors], dim=0))
+
+            # only the dc band depends on the colors, converted in place in the already copied colors. The rest of
+            # the SH coefficients start at zero and are filled straight into storage by append_gaussians
+            dc = colors
+            # producers hand over either [0, 1] or [0, 255] colors, pick the scale on the device rather than
+            # branching on colors.max() in python, which would sync every add
+            dc.mul_(torch.where(colors.amax() > 1.0, 1 / 255, 1.0))
+            if self.config.sh_degree > 0:
+                RGB2SH_(dc)
+            else:
+                CONSOLE.log("use color only optimization with sigmoid activation")
+                dc.logit_(eps=1e-10)
+
+            self.append_gaussians(
+                {
+                    "means": deprojected,
+                    # every new point starts with the same isotropic scale of 0.02, constants are filled straight
+                    # into the parameter storage without materializing them first
+                    "scales": math.log(0.02),
+                    "quats": random_quat_tensor(numpts, device=self.device),
+                    "features_dc": dc,
+                    "features_rest": 0.0,
+                    "opacities": self._logit_init_opacity,
+                }
+            )
+            
 
+            self.xys_grad_norm = None
+            self.vis_counts = None
+            self.max_2Dsize = None
+            
+            # Adding only the new parameters to the optimizer
+            with self.optim_maintenance():
+                self.extend_all_optim(optimizers, numpts, fill=0.4)
+
+            # if self.num_points == self.config.num_random + numpts:
+            #     print("removing random init")
+            #     with torch.no_grad():
+            #         mask = torch.cat(
+            #             (
+            #             torch.ones(self.config.num_random, device=self.device, dtype=torch.bool),
+            #             torch.zeros(self.num_points - self.config.num_random, device=self.device, dtype=torch.bool)
+            #             )
+            #         )
+            #         deleted_mask = self.cull_gaussians(mask, max(0.02, self.config.init_opacity - 0.05))
+            #         # import pdb; pdb.set_trace()
+            #         self.remove_from_all_optim(optimizers, deleted_mask)
         
-        param_state["exp_avg"] = torch.cat(
-            [param_state["exp_avg"], torch.ones_like(param_state["exp_avg"][-1]).repeat(*repeat_dims) * 0.4],
-            dim=0,
-        )
-        param_state["exp_avg_sq"] = torch.cat(
-            [
-                param_state["exp_avg_sq"],
-                torch.ones_like(param_state["exp_avg_sq"][-1]).repeat(*repeat_dims) * 0.4,
-            ],
-            dim=0,
-        )
-
-        del optimizer.state[param]
-        optimizer.state[new_param_groups[0]] = param_state
+        ## Deproject Debug
+        # means_freeze = self.means.data.clone().cpu()
+        # colors_freeze = self.clrs.data.clone().cpu()
+        # self.viewer_control.viser_server.add_point_cloud("deprojected", means_freeze.numpy(force=True) * VISER_NERFSTUDIO_SCALE_RATIO, colors_freeze.numpy(force=True), 0.1)
+        # import pdb; pdb.set_trace()
 
-        optimizer.param_groups[0]["params"] = new_param_groups
-        del param
+        # no empty_cache here: adding points only grows allocations, so it would just force a device sync
+        self.deprojected_new.clear()
+        self.colors_new.clear()
+        self.steps_since_add = 0
+        self.postBA = True
 
-    def add_deprojected_means(self, deprojected, colors, optimizers: Optimizers, step):
-        if len(deprojected) > 0:
-            with torch.no_grad():
-                # import pdb; pdb.set_trace()
-                # deprojected = torch.stack(deprojected, dim=0).to(self.device)
-                # colors = torch.stack(colors, dim=0).to(self.device)
-                deprojected = deprojected[0]
-                colors = colors[0]
-                numpts = len(deprojected)
-                avg_dist = torch.ones_like(deprojected.mean(dim=-1).unsqueeze(-1)) * 0.02 #* 0.01
-
-                # if self.clrs == None:
-                #     self.clrs = torch.nn.Parameter(torch.cat([self.means.detach(), colors], dim=0))
-                # else:
-                #     self.clrs = torch.nn.Parameter(torch.cat([self.clrs.detach(), colors], dim=0))
-
-                dim_sh = num_sh_bases(self.config.sh_degree)
-                if colors.max() > 1.0:
-                    colors = colors / 255
-                    assert colors.max() <= 1.0
-                
-                shs = torch.zeros((colors.shape[0], dim_sh, 3)).float().cuda()
-                if self.config.sh_degree > 0:
-                    shs[:, 0, :3] = RGB2SH(colors)
-                    shs[:, 1:, 3:] = 0.0
+    def remove_from_all_optim(self, optimizers: Optimizers, keep: torch.Tensor):
+        """
+        Keeps only the keep rows of the Adam moments of every gaussian param group, to match a keep_gaussians
+        call. Moments are compacted into their existing storage (see extend_all_optim) and the optimizer state
+        stays keyed on the same Parameter objects.
+        keep: the index tensor passed to keep_gaussians, reused so the mask is only resolved (and synced) once
+        """
+        for group in self.gauss_params.keys():
+            optimizer = optimizers.optimizers[group]
+            param_state = optimizer.state[optimizer.param_groups[0]["params"][0]]
+            for key in ("exp_avg", "exp_avg_sq"):
+                if key not in param_state:
+                    continue
+                state = param_state[key]
+                kept = state.index_select(0, keep)
+                buf = self._optim_storage.get((group, key))
+                if buf is not None and buf.data_ptr() == state.data_ptr():
+                    buf[: kept.shape[0]] = kept
+                    kept = buf[: kept.shape[0]]
                 else:
-                    CONSOLE.log("use color only optimization with sigmoid activation")
-                    shs[:, 0, :3] = torch.logit(colors, eps=1e-10)
-
-                self.gauss_params['means'] = torch.nn.Parameter(torch.cat([self.gauss_params['means'].detach(), deprojected], dim=0))
-                self.gauss_params['scales'] = torch.nn.Parameter(torch.cat([self.gauss_params['scales'].detach(), torch.log(avg_dist.repeat(1, 3)).float().cuda()], dim=0))
-                self.gauss_params['quats'] = torch.nn.Parameter(torch.cat([self.gauss_params['quats'].detach(), random_quat_tensor(numpts).float().cuda()]))
-                self.gauss_params['features_dc'] = torch.nn.Parameter(torch.cat([self.gauss_params['features_dc'].detach(), shs[:, 0, :].to(self.device)]))
-                self.gauss_params['features_rest'] = torch.nn.Parameter(torch.cat([self.gauss_params['features_rest'].detach(), shs[:, 1:, :].to(self.device)]))
-                self.gauss_params['opacities'] = torch.nn.Parameter(torch.cat([self.gauss_params['opacities'].detach(), torch.logit(self.config.init_opacity * torch.ones(numpts, 1)).to(self.device)], dim=0))
-                
+                    self._optim_storage[(group, key)] = kept
+                self._set_optim_state(param_state, key, kept)
 
-                self.xys_grad_norm = None
-                self.vis_counts = None
-                self.max_2Dsize = None
-                
-                num_new_points = deprojected.shape[0]
-                
-                # Adding only the new parameters to the optimizer
-                # new_gaussian_params = [new_means, new_scales, new_quats, new_colors_all, new_opacities]
-                param_groups = self.get_gaussian_param_groups()
-                for group, param in param_groups.items():
-                    if group == 'lerf':
-                        continue
-                    new_param = [param[0][-num_new_points:]]
-                    self.add_new_params_to_optimizer(optimizers.optimizers[group], new_param)
-
-                # if self.num_points == self.config.num_random + numpts:
-                #     print("removing random init")
-                #     with torch.no_grad():
-                #         mask = torch.cat(
-                #             (
-                #             torch.ones(self.config.num_random, device=self.device, dtype=torch.bool),
-                #             torch.zeros(self.num_points - self.config.num_random, device=self.device, dtype=torch.bool)
-                #             )
-                #         )
-                #         deleted_mask = self.cull_gaussians(mask, max(0.02, self.config.init_opacity - 0.05))
-                #         # import pdb; pdb.set_trace()
-                #         self.remove_from_all_optim(optimizers, deleted_mask)
-            
-            ## Deproject Debug
-            # means_freeze = self.means.data.clone().cpu()
-            # colors_freeze = self.clrs.data.clone().cpu()
-            # self.viewer_control.viser_server.add_point_cloud("deprojected", means_freeze.numpy(force=True) * VISER_NERFSTUDIO_SCALE_RATIO, colors_freeze.numpy(force=True), 0.1)
-            # import pdb; pdb.set_trace()
+    def extend_all_optim(self, optimizers: Optimizers, num_new: int, fill: float = 0.0):
+        """
+        Grows the Adam moments of every gaussian param group by num_new rows filled with fill, to match an
+        append_gaussians call. Like gauss_params the moments are views into storage that doubles when it runs
+        out, so this is usually a single fill per moment. append_gaussians keeps the Parameter objects, so the
+        optimizer state does not need to be re-keyed.
+        """
+        for group in self.gauss_params.keys():
+            optimizer = optimizers.optimizers[group]
+            param_state = optimizer.state[optimizer.param_groups[0]["params"][0]]
+            for key in ("exp_avg", "exp_avg_sq"):
+                if key not in param_state:
+                    # adam hasn't stepped yet, it will allocate moments of the right size itself
+                    continue
+                state = param_state[key]
+                n = state.shape[0]
+                buf = self._optim_storage.get((group, key))
+                if buf is None or buf.data_ptr() != state.data_ptr() or buf.shape[0] < n + num_new:
+                    buf = state.new_empty((max(2 * n, n + num_new),) + state.shape[1:])
+                    buf[:n] = state
+                    self._optim_storage[(group, key)] = buf
+                buf[n : n + num_new] = fill
+                self._set_optim_state(param_state, key, buf[: n + num_new])
+
+    def optim_state_dict(self, optimizer: torch.optim.Optimizer) -> dict:
+        """
+        optimizer.state_dict() for checkpointing, with the adam moments cloned out of the over-allocated storage
+        they are views into (see extend_all_optim), so checkpoints don't serialize the unused capacity. Like
+        _clone_gauss_state_dict does for gauss_params. The live optimizer state is left untouched
+        """
+        state_dict = optimizer.state_dict()
+        state_dict["state"] = {
+            idx: {
+                name: value.clone() if isinstance(value, torch.Tensor) and value._base is not None else value
+                for name, value in param_state.items()
+            }
+            for idx, param_state in state_dict["state"].items()
+        }
+        return state_dict
 
-            colors = colors.detach()
-            deprojected = deprojected.detach()
-            del colors
-            del deprojected
-            torch.cuda.empty_cache()
-            self.deprojected_new.clear()
-            self.colors_new.clear()
-            self.steps_since_add = 0
-            self.postBA = True
-
-    def remove_from_optim(self, optimizer, deleted_mask, new_params):
-        """removes the deleted_mask from the optimizer provided"""
-        assert len(new_params) == 1
-        # assert isinstance(optimizer, torch.optim.Adam), "Only works with Adam"
-
-        param = optimizer.param_groups[0]["params"][0]
-        param_state = optimizer.state[param]
-        del optimizer.state[param]
-
-        # Modify the state directly without deleting and reassigning.
-        if "exp_avg" in param_state:
-            param_state["exp_avg"] = param_state["exp_avg"][~deleted_mask]
-            param_state["exp_avg_sq"] = param_state["exp_avg_sq"][~deleted_mask]
-
-        # Update the parameter in the optimizer's param group.
-        del optimizer.param_groups[0]["params"][0]
-        del optimizer.param_groups[0]["params"]
-        optimizer.param_groups[0]["params"] = new_params
-        optimizer.state[new_params[0]] = param_state
-
-    def remove_from_all_optim(self, optimizers, deleted_mask):
-        param_groups = self.get_gaussian_param_groups()
-        for group, param in param_groups.items():
-            if group == 'lerf':
-                continue
-            self.remove_from_optim(optimizers.optimizers[group], deleted_mask, param)
-        torch.cuda.empty_cache()
-
-    def dup_in_optim(self, optimizer, dup_mask, new_params, n=2):
-        """adds the parameters to the optimizer"""
-        param = optimizer.param_groups[0]["params"][0]
-        param_state = optimizer.state[param]
-        if "exp_avg" in param_state:
-            repeat_dims = (n,) + tuple(1 for _ in range(param_state["exp_avg"].dim() - 1))
-            param_state["exp_avg"] = torch.cat(
-                [
-                    param_state["exp_avg"],
-                    torch.zeros_like(param_state["exp_avg"][dup_mask.squeeze()]).repeat(*repeat_dims),
-                ],
-                dim=0,
-            )
-            param_state["exp_avg_sq"] = torch.cat(
-                [
-                    param_state["exp_avg_sq"],
-                    torch.zeros_like(param_state["exp_avg_sq"][dup_mask.squeeze()]).repeat(*repeat_dims),
-                ],
-                dim=0,
-            )
-        del optimizer.state[param]
-        optimizer.state[new_params[0]] = param_state
-        optimizer.param_groups[0]["params"] = new_params
-        del param
-
-    def dup_in_all_optim(self, optimizers, dup_mask, n):
-        param_groups = self.get_gaussian_param_groups()
-        for group, param in param_groups.items():
-            if group == 'lerf':
-                continue
-            self.dup_in_optim(optimizers.optimizers[group], dup_mask, param, n)
+    @contextlib.contextmanager
+    def optim_maintenance(self) -> Iterator[None]:
+        """
+        Runs the enclosed adam moment updates (extend_all_optim, remove_from_all_optim, resets) on a side stream
+        so they overlap with the start of the next iteration. The side stream first waits for the work already
+        queued, and step_cb makes the default stream wait for it before the next iteration starts.
+        """
+        if self.device.type != "cuda":
+            yield
+            return
+        if self._maint_stream is None:
+            self._maint_stream = torch.cuda.Stream(device=self.device)
+        self._maint_stream.wait_stream(torch.cuda.current_stream(self.device))
+        with torch.cuda.stream(self._maint_stream):
+            yield
+        self._maint_event = self._maint_stream.record_event()
+
+    def wait_optim_maintenance(self):
+        """
+        Makes the current stream wait for pending optim_maintenance work, anything reading the optimizer state
+        outside the training step (eg. checkpointing) has to call this first
+        """
+        if self._maint_event is not None:
+            # only the event, not a full device sync
+            torch.cuda.current_stream(self.device).wait_event(self._maint_event)
+            self._maint_event = None
+
+    def _set_optim_state(self, param_state, key: str, new: torch.Tensor):
+        """
+        Replaces an adam moment. Inside optim_maintenance this also tells the caching allocator that the old
+        moment is still being read on the side stream, and that the new one will be used by the default stream.
+        """
+        old = param_state[key]
+        if old.is_cuda:
+            stream = torch.cuda.current_stream(old.device)
+            default = torch.cuda.default_stream(old.device)
+            if stream != default:
+                old.record_stream(stream)
+                new.record_stream(default)
+        param_state[key] = new
 
     def after_train(self, step: int):
         assert step == self.step
@@ -568,28 +944,25 @@ class LLGaussianSplattingModel(SplatfactoModel):
             return
         with torch.no_grad():
             # keep track of a moving average of grad norms
-            visible_mask = (self.radii > 0).flatten()
-            grads = self.xys.absgrad[0][visible_mask].norm(dim=-1)  # type: ignore
-            # print(f"grad norm min {grads.min().item()} max {grads.max().item()} mean {grads.mean().item()} size {grads.shape}")
             if self.xys_grad_norm is None:
                 self.xys_grad_norm = torch.zeros(self.num_points, device=self.device, dtype=torch.float32)
                 self.vis_counts = torch.ones(self.num_points, device=self.device, dtype=torch.float32)
             assert self.vis_counts is not None
-            self.vis_counts[visible_mask] += 1
-            self.xys_grad_norm[visible_mask] += grads
+            # masked gather/scatter would run a nonzero per call, blend over all N elementwise instead
+            accumulate_grad_stats(self.xys.absgrad[0], self.radii, self.xys_grad_norm, self.vis_counts)  # type: ignore
 
     def set_crop(self, crop_box: Optional[OrientedBox]):
         self.crop_box = crop_box
 
     def set_background(self, background_color: torch.Tensor):
         assert background_color.shape == (3,)
-        self.background_color = background_color
+        self.background_color.copy_(background_color)
 
     def refinement_after(self, optimizers: Optimizers, step):
         assert step == self.step
         if self.step <= self.config.warmup_length:
             return
-        deleted_mask = None
+        kept = None
         with torch.no_grad():
             # Offset all the opacity reset logic by refine_every so that we don't
             # save checkpoints right when the opacity is reset (saves every 2k)
@@ -605,61 +978,57 @@ class LLGaussianSplattingModel(SplatfactoModel):
                 assert self.xys_grad_norm is not None and self.vis_counts is not None
                 avg_grad_norm = (self.xys_grad_norm / self.vis_counts) * 0.5 * max(self.last_size[0], self.last_size[1])
                 high_grads = (avg_grad_norm > self.config.densify_grad_thresh).squeeze()
-                splits = (self.scales.exp().max(dim=-1).values > self.config.densify_size_thresh).squeeze()
-                splits &= high_grads
+                # exp is monotonic so compare the log scales against log(thresh)
+                log_size_thresh = math.log(self.config.densify_size_thresh)
+                # resolved to (sorted) indices once here, the split/dup gathers and the pruning mask all reuse them
+                split_idcs = ((self.scales.amax(dim=-1) > log_size_thresh).squeeze() & high_grads).nonzero(as_tuple=True)[0]
                 nsamps = self.config.n_split_samples
-                split_params = self.split_gaussians(splits, nsamps)
-
-                dups = (self.scales.exp().max(dim=-1).values <= self.config.densify_size_thresh).squeeze()
-                dups &= high_grads
-                dup_params = self.dup_gaussians(dups)
-                for name, param in self.gauss_params.items():
-                    self.gauss_params[name] = torch.nn.Parameter(
-                        torch.cat([param.detach(), split_params[name], dup_params[name]], dim=0)
-                    )
+                split_params = self.split_gaussians(split_idcs, nsamps)
 
-                split_idcs = torch.where(splits)[0]
-                self.dup_in_all_optim(optimizers, split_idcs, nsamps)
+                # classified after split_gaussians has shrunk the split gaussians, so the ones that drop below the
+                # threshold are duplicated too
+                dup_idcs = ((self.scales.amax(dim=-1) <= log_size_thresh).squeeze() & high_grads).nonzero(as_tuple=True)[0]
+                dup_params = self.dup_gaussians(dup_idcs)
+                # appended one after the other straight into the parameter storage, no concatenated temporaries
+                num_split, num_dup = split_params["means"].shape[0], dup_params["means"].shape[0]
+                self.append_gaussians(split_params)
+                self.append_gaussians(dup_params)
 
-                dup_idcs = torch.where(dups)[0]
-                self.dup_in_all_optim(optimizers, dup_idcs, 1)
+                with self.optim_maintenance():
+                    self.extend_all_optim(optimizers, num_split + num_dup)
 
                 # After a guassian is split into two new gaussians, the original one should also be pruned.
-                splits_mask = torch.cat(
-                    (
-                        splits,
-                        torch.zeros(
-                            nsamps * splits.sum() + dups.sum(),
-                            device=self.device,
-                            dtype=torch.bool,
-                        ),
-                    )
-                )
+                splits_mask = torch.zeros(self.num_points, device=self.device, dtype=torch.bool)
+                splits_mask.index_fill_(0, split_idcs, True)
                 if self.steps_since_add >= 5500 and self.postBA and self.steps_since_add < 10000:
-                    deleted_mask = self.cull_gaussians(splits_mask)
+                    kept = self.cull_gaussians(splits_mask)
             elif self.step >= self.config.stop_split_at and self.config.continue_cull_post_densification:
                 if self.steps_since_add >= 5500 and self.postBA and self.steps_since_add < 10000:
-                    deleted_mask = self.cull_gaussians()
+                    kept = self.cull_gaussians()
             else:
                 # if we donot allow culling post refinement, no more gaussians will be pruned.
-                deleted_mask = None
+                kept = None
 
-            if deleted_mask is not None:
-                self.remove_from_all_optim(optimizers, deleted_mask)
+            if kept is not None:
+                with self.optim_maintenance():
+                    if kept.is_cuda:
+                        # allocated on the default stream but read on the maintenance stream, keep the allocator from
+                        # handing its block out again before the gathers below have run
+                        kept.record_stream(torch.cuda.current_stream(kept.device))
+                    self.remove_from_all_optim(optimizers, kept)
 
             if self.step < self.config.stop_split_at and self.step % reset_interval == self.config.refine_every:
                 # Reset value is set to be twice of the cull_alpha_thresh
-                reset_value = self.config.cull_alpha_thresh * 2.0
-                self.opacities.data = torch.clamp(
-                    self.opacities.data,
-                    max=torch.logit(torch.tensor(reset_value, device=self.device)).item(),
-                )
+                # in place, so opacities stays a view of its storage. Through detach() rather than .data so the
+                # version counter is bumped and the activation caches see the reset
+                self.opacities.detach().clamp_(max=self._logit_reset_alpha)
                 # reset the exp of optimizer
                 optim = optimizers.optimizers["opacities"]
                 param = optim.param_groups[0]["params"][0]
                 param_state = optim.state[param]
-                param_state["exp_avg"] = torch.zeros_like(param_state["exp_avg"])
-                param_state["exp_avg_sq"] = torch.zeros_like(param_state["exp_avg_sq"])
+                with self.optim_maintenance():
+                    param_state["exp_avg"].zero_()
+                    param_state["exp_avg_sq"].zero_()
 
             self.xys_grad_norm = None
             self.vis_counts = None
@@ -668,54 +1037,62 @@ class LLGaussianSplattingModel(SplatfactoModel):
         """
         This function deletes gaussians with under a certain opacity threshold
         extra_cull_mask: a mask indicates extra gaussians to cull besides existing culling criterion
+        Returns the indices of the remaining gaussians, for remove_from_all_optim
         """
         n_bef = self.num_points
-        # cull transparent ones
-        culls = (torch.sigmoid(self.opacities) < self.config.cull_alpha_thresh).squeeze()
-        below_alpha_count = torch.sum(culls).item()
-        toobigs_count = 0
-        if extra_cull_mask is not None:
-            culls = culls | extra_cull_mask
-        if self.step > self.config.refine_every * self.config.reset_alpha_every:
-            # cull huge ones
-            toobigs = (torch.exp(self.scales).max(dim=-1).values > self.config.cull_scale_thresh).squeeze()
-            culls = culls | toobigs
-            toobigs_count = torch.sum(toobigs).item()
-        for name, param in self.gauss_params.items():
-            self.gauss_params[name] = torch.nn.Parameter(param[~culls])
+        # cull transparent ones, and after the first opacity reset huge ones too
+        # sigmoid and exp are monotonic, so the raw params are compared against logit/log of the thresholds
+        culls, counts = cull_predicate(
+            self.opacities.detach(),
+            self.scales.detach(),
+            extra_cull_mask,
+            self._logit_cull_alpha,
+            math.log(self.config.cull_scale_thresh),
+            self.step > self.config.refine_every * self.config.reset_alpha_every,
+        )
+        # resolve the mask to indices once and gather every parameter with it
+        keep_idx = (~culls).nonzero(as_tuple=True)[0]
+        self.keep_gaussians(keep_idx)
+        # both counts in one readback, the nonzero above has synced already anyway
+        below_alpha_count, toobigs_count = counts.tolist()
 
         CONSOLE.log(
             f"Culled {n_bef - self.num_points} gaussians "
             f"({below_alpha_count} below alpha thresh, {toobigs_count} too bigs, {self.num_points} remaining)"
         )
 
-        return culls
+        return keep_idx
 
-    def split_gaussians(self, split_mask, samps):
+    def split_gaussians(self, split_idcs, samps):
         """
         This function splits gaussians that are too large
+        split_idcs: indices of the gaussians to split. Each parameter's split rows are gathered a single time
         """
-        n_splits = split_mask.sum().item()
-        CONSOLE.log(f"Splitting {split_mask.sum().item()/self.num_points} gaussians: {n_splits}/{self.num_points}")
+        n_splits = split_idcs.shape[0]
+        CONSOLE.log(f"Splitting {n_splits/self.num_points} gaussians: {n_splits}/{self.num_points}")
+        split = {name: param.data.index_select(0, split_idcs) for name, param in self.gauss_params.items()}
         centered_samples = torch.randn((samps * n_splits, 3), device=self.device)  # Nx3 of axis-aligned scales
-        scaled_samples = (
-            torch.exp(self.scales[split_mask].repeat(samps, 1)) * centered_samples
-        )  # how these scales are rotated
-        quats = self.quats[split_mask] / self.quats[split_mask].norm(dim=-1, keepdim=True)  # normalize them first
-        rots = quat_to_rotmat(quats.repeat(samps, 1))  # how these scales are rotated
-        rotated_samples = torch.bmm(rots, scaled_samples[..., None]).squeeze()
-        new_means = rotated_samples + self.means[split_mask].repeat(samps, 1)
+        # exp once per split gaussian and broadcast over the samps blocks (the layout repeat(samps, 1) gives),
+        # instead of exponentiating a repeated copy
+        scaled_samples = centered_samples.view(samps, n_splits, 3).mul_(torch.exp(split["scales"])).view(-1, 3)
+        quats = F.normalize(split["quats"], dim=-1)  # normalize them first
+        # rotated straight by the quats, broadcast over the samps blocks
+        rotated_samples = rotate_by_quats(quats, scaled_samples.view(samps, n_splits, 3))
+        new_means = rotated_samples.add_(split["means"]).view(-1, 3)
+        # everything except the means is the same for every sample, so the rest are (samps, N, ...) expanded views
+        # that append_gaussians copies straight into storage, never materializing the repeats
         # step 2, sample new colors
-        new_features_dc = self.features_dc[split_mask].repeat(samps, 1)
-        new_features_rest = self.features_rest[split_mask].repeat(samps, 1, 1)
+        new_features_dc = split["features_dc"].expand(samps, -1, -1)
+        new_features_rest = split["features_rest"].expand(samps, -1, -1, -1)
         # step 3, sample new opacities
-        new_opacities = self.opacities[split_mask].repeat(samps, 1)
+        new_opacities = split["opacities"].expand(samps, -1, -1)
         # step 4, sample new scales
-        size_fac = 1.6
-        new_scales = torch.log(torch.exp(self.scales[split_mask]) / size_fac).repeat(samps, 1)
-        self.scales[split_mask] = torch.log(torch.exp(self.scales[split_mask]) / size_fac)
+        # log(exp(s) / size_fac), computed once and shared by the originals and the samples
+        shrunk_scales = split["scales"] - LOG_SPLIT_SIZE_FAC
+        new_scales = shrunk_scales.expand(samps, -1, -1)
+        self.scales.data.index_copy_(0, split_idcs, shrunk_scales)
         # step 5, sample new quats
-        new_quats = self.quats[split_mask].repeat(samps, 1)
+        new_quats = split["quats"].expand(samps, -1, -1)
         out = {
             "means": new_means,
             "features_dc": new_features_dc,
@@ -726,18 +1103,19 @@ class LLGaussianSplattingModel(SplatfactoModel):
         }
         for name, param in self.gauss_params.items():
             if name not in out:
-                out[name] = param[split_mask].repeat(samps, 1)
+                out[name] = split[name].expand(samps, *split[name].shape)
         return out
 
-    def dup_gaussians(self, dup_mask):
+    def dup_gaussians(self, dup_idcs):
         """
         This function duplicates gaussians that are too small
+        dup_idcs: indices of the gaussians to duplicate
         """
-        n_dups = dup_mask.sum().item()
-        CONSOLE.log(f"Duplicating {dup_mask.sum().item()/self.num_points} gaussians: {n_dups}/{self.num_points}")
+        n_dups = dup_idcs.shape[0]
+        CONSOLE.log(f"Duplicating {n_dups/self.num_points} gaussians: {n_dups}/{self.num_points}")
         new_dups = {}
         for name, param in self.gauss_params.items():
-            new_dups[name] = param[dup_mask]
+            new_dups[name] = param.data.index_select(0, dup_idcs)
         return new_dups
 
     def get_training_callbacks(
@@ -771,17 +1149,23 @@ class LLGaussianSplattingModel(SplatfactoModel):
 
     def step_cb(self, step):
         self.step = step
+        self.wait_optim_maintenance()
 
     def get_gaussian_param_groups(self) -> Dict[str, List[Parameter]]:
         # Here we explicitly use the means, scales as parameters so that the user can override this function and
         # specify more if they want to add more optimizable params to gaussians.
-        gpg = {
-            name: [self.gauss_params[name]]
-            for name in ["means", "scales", "quats", "features_dc", "features_rest", "opacities"]
-        }
-        gpg["lerf"] = list(self.gaussian_lerf_field.parameters())
+        # The trainer asks for these every step. Adding, densifying, culling and loading all resize the gaussians
+        # in place, so the Parameter objects never change and the groups are built once. Callers must not mutate
+        # the returned dict (get_param_groups copies it)
+        if self._param_groups_cache is None:
+            gpg = {
+                name: [self.gauss_params[name]]
+                for name in ["means", "scales", "quats", "features_dc", "features_rest", "opacities"]
+            }
+            gpg["lerf"] = list(self.gaussian_lerf_field.parameters())
+            self._param_groups_cache = gpg
 
-        return gpg
+        return self._param_groups_cache
 
     def get_param_groups(self) -> Dict[str, List[Parameter]]:
         """Obtain the parameter groups for the optimizers
@@ -789,7 +1173,8 @@ class LLGaussianSplattingModel(SplatfactoModel):
         Returns:
             Mapping of different parameter groups
         """
-        gps = self.get_gaussian_param_groups()
+        # copied, camera_optimizer adds its own group to the dict
+        gps = dict(self.get_gaussian_param_groups())
         self.camera_optimizer.get_param_groups(param_groups=gps)
         return gps
 
@@ -808,9 +1193,46 @@ class LLGaussianSplattingModel(SplatfactoModel):
             return resize_image(image, d)
         return image
 
+    # gsplat's custom CUDA autograd functions can't be traced, so keep dynamo out entirely and let any compiled
+    # caller graph-break cleanly here instead of attempting (and abandoning) a trace of the rasterizer
+    @torch._dynamo.disable
+    def rasterize(self, means, quats, scales, opacities, colors, viewmat, K, W, H, render_mode="RGB", sh_degree=None):
+        """
+        Single entry point for gaussian rasterization, shared by the RGB, CLIP and relevancy passes so the
+        rasterizer backend only has to be swapped here.
+
+        Args:
+            quats: normalized quaternions
+            scales: activated (exp) scales
+            opacities: activated (sigmoid) opacities of shape [N]
+            colors: SH coefficients when sh_degree is set, otherwise per-gaussian features
+        """
+        return rasterization(
+            means=means,
+            quats=quats,
+            scales=scales,
+            opacities=opacities,
+            colors=colors,
+            viewmats=viewmat,  # [1, 4, 4]
+            Ks=K,  # [1, 3, 3]
+            width=W,
+            height=H,
+            tile_size=16,  # this controls the tile size of rasterization, 16 is a good default
+            packed=False,
+            near_plane=0.01,
+            far_plane=1e10,
+            render_mode=render_mode,
+            sh_degree=sh_degree,
+            sparse_grad=False,
+            absgrad=True,
+            rasterize_mode=self.config.rasterize_mode,
+            # set some threshold to disregrad small gaussians for faster rendering.
+            # radius_clip=3.0,
+        )
+
     @staticmethod
     def get_empty_outputs(width: int, height: int, background: torch.Tensor) -> Dict[str, Union[torch.Tensor, List]]:
-        rgb = background.repeat(height, width, 1)
+        rgb = background.expand(height, width, 3)
         depth = background.new_ones(*rgb.shape[:2], 1) * 10
         accumulation = background.new_zeros(*rgb.shape[:2], 1)
         return {"rgb": rgb, "depth": depth, "accumulation": accumulation, "background": background}
@@ -830,7 +1252,6 @@ class LLGaussianSplattingModel(SplatfactoModel):
             return {}
 
         outputs = {}
-        optimized_camera_to_world = self.camera_optimizer.apply_to_camera(camera)[0, ...]
 
         # get the background color
         if self.training:
@@ -838,86 +1259,105 @@ class LLGaussianSplattingModel(SplatfactoModel):
             optimized_camera_to_world = self.camera_optimizer.apply_to_camera(camera)
 
             if self.config.background_color == "random":
-                background = torch.rand(3, device=self.device)
+                background = self._bg_buf.uniform_()
             elif self.config.background_color == "white":
-                background = torch.ones(3, device=self.device)
+                background = self._bg_buf.fill_(1.0)
             elif self.config.background_color == "black":
-                background = torch.zeros(3, device=self.device)
+                background = self._bg_buf.fill_(0.0)
             else:
-                background = self.background_color.to(self.device)
+                background = self.background_color
         else:
             optimized_camera_to_world = camera.camera_to_worlds
 
             if renderers.BACKGROUND_COLOR_OVERRIDE is not None:
                 background = renderers.BACKGROUND_COLOR_OVERRIDE.to(self.device)
             else:
-                background = self.background_color.to(self.device)
+                background = self.background_color
 
+        # read all camera scalars back in one transfer instead of one sync per .item()
+        fx, fy, cx, cy, width, height = torch.cat(
+            [camera.fx[0], camera.fy[0], camera.cx[0], camera.cy[0], camera.width[0], camera.height[0]]
+        ).tolist()
         if self.crop_box is not None and not self.training:
-            crop_ids = self.crop_box.within(self.means).squeeze()
-            if crop_ids.sum() == 0:
-                return self.get_empty_outputs(int(camera.width.item()), int(camera.height.item()), background)
+            # resolve the mask to indices once, boolean indexing would redo the nonzero (and sync) per field, and
+            # the emptiness check comes for free from the index count instead of a separate .sum() readback
+            crop_idx = self.crop_box.within(self.means).squeeze().nonzero(as_tuple=True)[0]
+            if crop_idx.numel() == 0:
+                return self.get_empty_outputs(int(width), int(height), background)
         else:
-            crop_ids = None
+            crop_idx = None
         camera_scale_fac = 1.0 / self._get_downscale_factor()
         viewmat = get_viewmat(optimized_camera_to_world)
-        W, H = int(camera.width[0] * camera_scale_fac), int(camera.height[0] * camera_scale_fac)
+        W, H = int(width * camera_scale_fac), int(height * camera_scale_fac)
         self.last_size = (H, W)
 
-        if crop_ids is not None:
-            opacities_crop = self.opacities[crop_ids]
-            means_crop = self.means[crop_ids]
-            features_dc_crop = self.features_dc[crop_ids]
-            features_rest_crop = self.features_rest[crop_ids]
-            scales_crop = self.scales[crop_ids]
-            quats_crop = self.quats[crop_ids]
+        if (
+            not self.training
+            and self.datamanager.use_clip
+            and self.step - self.datamanager.lerf_step > 500
+            and (camera.metadata is None or "clip_downscale_factor" in camera.metadata)
+        ):
+            # the relevancy pass below needs the clip hash, start it now so it overlaps the RGB rasterization
+            self.prefetch_clip_hash()
+
+        if self.config.sh_degree > 0:
+            sh_degree_to_use = min(self.step // self.config.sh_degree_interval, self.config.sh_degree)
+        else:
+            sh_degree_to_use = None
+
+        # activated once and shared by the RGB and CLIP passes
+        scales_act, opacities_act, colors_crop = self.activated_gaussians(sh_degree_to_use)
+        if crop_idx is not None:
+            means_crop = self.means.index_select(0, crop_idx)
+            quats_crop = self.normalized_quats().index_select(0, crop_idx)
+            scales_act = scales_act.index_select(0, crop_idx)
+            opacities_act = opacities_act.index_select(0, crop_idx)
+            colors_crop = colors_crop.index_select(0, crop_idx)
         else:
-            opacities_crop = self.opacities
             means_crop = self.means
-            features_dc_crop = self.features_dc
-            features_rest_crop = self.features_rest
-            scales_crop = self.scales
-            quats_crop = self.quats
-
-        colors_crop = torch.cat((features_dc_crop[:, None, :], features_rest_crop), dim=1)
-        BLOCK_WIDTH = 16  # this controls the tile size of rasterization, 16 is a good default
-        K = camera.get_intrinsics_matrices().cuda()
-        K[:, :2, :] *= camera_scale_fac
+            quats_crop = self.normalized_quats()
+
+        K = intrinsics_matrix(
+            fx * camera_scale_fac, fy * camera_scale_fac, cx * camera_scale_fac, cy * camera_scale_fac, self.device
+        )
         # apply the compensation of screen space blurring to gaussians
         if self.config.rasterize_mode not in ["antialiased", "classic"]:
             raise ValueError("Unknown rasterize_mode: %s", self.config.rasterize_mode)
 
-        if self.config.output_depth_during_training or not self.training:
+        # the CLIP field is only supervised on some steps, the rest don't need depth at all
+        reset_interval = self.config.reset_alpha_every * self.config.refine_every
+        train_clip = (
+            self.training
+            and self.datamanager.use_clip
+            and self.step - self.datamanager.lerf_step > 500
+            and camera.metadata is not None
+            and "clip_downscale_factor" in camera.metadata
+            and self.step > self.config.warmup_length
+            and (
+                self.step % reset_interval > self.num_train_data + self.config.refine_every
+                or self.step < reset_interval
+            )
+        )
+
+        # depth comes out of the same rasterization as a 4th (expected depth) channel, sharing the sort and
+        # alpha blend with rgb, so there's no separate depth pass
+        if self.config.output_depth_during_training or not self.training or train_clip:
             render_mode = "RGB+ED"
         else:
             render_mode = "RGB"
 
-        if self.config.sh_degree > 0:
-            sh_degree_to_use = min(self.step // self.config.sh_degree_interval, self.config.sh_degree)
-        else:
-            sh_degree_to_use = None
-
-        render, alpha, info = rasterization(
-            means=means_crop,
-            quats=quats_crop / quats_crop.norm(dim=-1, keepdim=True),
-            scales=torch.exp(scales_crop),
-            opacities=torch.sigmoid(opacities_crop).squeeze(-1),
-            colors=colors_crop,
-            viewmats=viewmat,  # [1, 4, 4]
-            Ks=K,  # [1, 3, 3]
-            width=W,
-            height=H,
-            tile_size=BLOCK_WIDTH,
-            packed=False,
-            near_plane=0.01,
-            far_plane=1e10,
+        render, alpha, info = self.rasterize(
+            means_crop,
+            quats_crop,
+            scales_act,
+            opacities_act,
+            colors_crop,
+            viewmat,
+            K,
+            W,
+            H,
             render_mode=render_mode,
             sh_degree=sh_degree_to_use,
-            sparse_grad=False,
-            absgrad=True,
-            rasterize_mode=self.config.rasterize_mode,
-            # set some threshold to disregrad small gaussians for faster rendering.
-            # radius_clip=3.0,
         )
         if self.training and info["means2d"].requires_grad:
             info["means2d"].retain_grad()
@@ -925,14 +1365,10 @@ class LLGaussianSplattingModel(SplatfactoModel):
         self.radii = info["radii"][0]  # [N]
 
         alpha = alpha[:, ...]
-        rgb = render[:, ..., :3] + (1 - alpha) * background
-        rgb = torch.clamp(rgb, 0.0, 1.0)
+        rgb, depth_im = finalize_render(render, alpha, background, render_mode == "RGB+ED")
         outputs["rgb"] = rgb.squeeze(0)
-        if render_mode == "RGB+ED":
-            depth_im = render[:, ..., 3:4]
-            depth_im = torch.where(alpha > 0, depth_im, depth_im.detach().max()).squeeze(0)
-        else:
-            depth_im = None
+        if depth_im is not None:
+            depth_im = depth_im.squeeze(0)
         outputs["depth"] = depth_im
         outputs["accumulation"] = alpha.squeeze(0)
         outputs["background"] = background
@@ -945,10 +1381,9 @@ class LLGaussianSplattingModel(SplatfactoModel):
                 ########################
                 # CLIP Relevancy Field #
                 ########################
-                reset_interval = self.config.reset_alpha_every * self.config.refine_every
-                if self.training and self.step>self.config.warmup_length and (self.step % reset_interval > self.num_train_data + self.config.refine_every  or self.step < (self.config.reset_alpha_every * self.config.refine_every)):
+                if train_clip:
                     # with torch.no_grad():
-                    clip_hash_encoding = self.gaussian_lerf_field.get_hash(self.means)
+                    clip_hash_encoding = self.gaussian_lerf_field.get_hash(means_crop)
                     # downscale_factor = camera.metadata["clip_downscale_factor"]
                     # print("K: ", K)
 
@@ -956,45 +1391,38 @@ class LLGaussianSplattingModel(SplatfactoModel):
 
                     downscale_factor = camera.metadata["clip_downscale_factor"] / rgb_downscale
 
-                    camera.rescale_output_resolution(1 / downscale_factor)
-                    clip_W, clip_H = camera.width.item(), camera.height.item()
+                    # same as camera.rescale_output_resolution(1 / downscale_factor), but from the scalars already read
+                    # back, so there's no second sync and no camera mutation to undo
+                    clip_fac = 1 / downscale_factor
+                    clip_W, clip_H = int(width * clip_fac), int(height * clip_fac)
                     # print(f"clip_W {clip_W} clip_H {clip_H}")
-                    clipK = camera.get_intrinsics_matrices().cuda()
+                    clipK = intrinsics_matrix(fx * clip_fac, fy * clip_fac, cx * clip_fac, cy * clip_fac, self.device)
                     # print("clipK: ", clipK)
                     
 
-                    field_output, alpha, info = rasterization(
-                        means=means_crop,
-                        quats=quats_crop / quats_crop.norm(dim=-1, keepdim=True),
-                        scales=torch.exp(scales_crop),
-                        opacities=torch.sigmoid(opacities_crop).squeeze(-1),
-                        colors=clip_hash_encoding,
-                        viewmats=viewmat, # [1, 4, 4]
-                        Ks=clipK,  # [1, 3, 3]
-                        width=clip_W,
-                        height=clip_H,
-                        tile_size=BLOCK_WIDTH,
-                        packed=False,
-                        near_plane=0.01,
-                        far_plane=1e10,
-                        render_mode="RGB",
-                        sparse_grad=False,
-                        absgrad=True,
-                        rasterize_mode=self.config.rasterize_mode,
-                        # set some threshold to disregrad small gaussians for faster rendering.
-                        # radius_clip=3.0,
+                    field_output, alpha, info = self.rasterize(
+                        means_crop,
+                        quats_crop,
+                        scales_act,
+                        opacities_act,
+                        clip_hash_encoding,
+                        viewmat,
+                        clipK,
+                        clip_W,
+                        clip_H,
                     )
 
-                    # rescale the camera back to original dimensions
-                    camera.rescale_output_resolution(downscale_factor)
-                    
 
-                    self.random_pixels = self.datamanager.random_pixels.to(self.device)
+                    # the datamanager only redraws the pixels with each new clip batch, keep the device copy until then
+                    if self._random_pixels_src is not self.datamanager.random_pixels:
+                        self._random_pixels_src = self.datamanager.random_pixels
+                        self.random_pixels = self._random_pixels_src.to(self.device)
 
-                    clip_scale = self.datamanager.curr_scale * torch.ones((self.random_pixels.shape[0],1),device=self.device)
-                    clip_scale = clip_scale * clip_H * (depth_im.view(-1, 1)[self.random_pixels] / camera.fy.item())
+                    # one gather, then a single multiply by a host scalar (fy was already read back above)
+                    clip_scale = depth_im.view(-1).index_select(0, self.random_pixels).unsqueeze(-1)
+                    clip_scale = clip_scale * (self.datamanager.curr_scale * clip_H / fy)
 
-                    field_output = self.gaussian_lerf_field.get_outputs_from_feature(field_output.view(clip_H*clip_W, -1)[self.random_pixels], clip_scale)
+                    field_output = self.gaussian_lerf_field.get_outputs_from_feature(field_output.view(clip_H*clip_W, -1).index_select(0, self.random_pixels), clip_scale)
 
                     clip_output = field_output[GaussianLERFFieldHeadNames.CLIP].to(dtype=torch.float32)
 
@@ -1003,10 +1431,11 @@ class LLGaussianSplattingModel(SplatfactoModel):
 
                 if not self.training:
                     # N x B x 1; N
-                    max_across, self.best_scales = self.get_max_across(means_crop, quats_crop, scales_crop, opacities_crop, viewmat, K, H, W, preset_scales=None)
+                    max_across, self.best_scales = self.get_max_across(means_crop, quats_crop, scales_act, opacities_act, viewmat, K, H, W, preset_scales=None, crop_idx=crop_idx)
 
+                    # max_across is already stacked over the positives, threshold all of them in one pass
+                    max_across.masked_fill_(max_across < self.relevancy_thresh.value, 0)
                     for i in range(len(self.image_encoder.positives)):
-                        max_across[i][max_across[i] < self.relevancy_thresh.value] = 0
                         # relevancy_rasterized[relevancy_rasterized < 0.5] = 0
                         outputs[f"relevancy_{i}"] = max_across[i].view(H, W, -1)
                         # outputs[f"relevancy_rasterized_{i}"] = relevancy_rasterized.view(H, W, -1)
@@ -1025,6 +1454,20 @@ class LLGaussianSplattingModel(SplatfactoModel):
         gt_img = self._downscale_if_required(image)
         return gt_img.to(self.device)
 
+    def get_composited_gt(self, image: torch.Tensor, background: torch.Tensor) -> torch.Tensor:
+        """
+        get_gt_img + composite_with_background, remembered for the last image/background pair since
+        get_metrics_dict and get_loss_dict both need it for the same batch every step. The training background
+        is refilled in place each step, so its version is part of the key as well as its identity
+        """
+        cache = self._gt_cache
+        key = (image._version, background._version)
+        if cache is not None and cache[0] is image and cache[1] is background and cache[2] == key:
+            return cache[3]
+        gt_img = self.composite_with_background(self.get_gt_img(image), background)
+        self._gt_cache = (image, background, key, gt_img)
+        return gt_img
+
     def composite_with_background(self, image, background) -> torch.Tensor:
         """Composite the ground truth image with a background color when it has an alpha channel.
 
@@ -1033,7 +1476,7 @@ class LLGaussianSplattingModel(SplatfactoModel):
             background: the background color
         """
         if image.shape[2] == 4:
-            alpha = image[..., -1].unsqueeze(-1).repeat((1, 1, 3))
+            alpha = image[..., -1:]  # broadcasts over the rgb channels
             return alpha * image[..., :3] + (1 - alpha) * background
         else:
             return image
@@ -1045,7 +1488,7 @@ class LLGaussianSplattingModel(SplatfactoModel):
             outputs: the output to compute loss dict to
             batch: ground truth batch corresponding to outputs
         """
-        gt_rgb = self.composite_with_background(self.get_gt_img(batch["image"]), outputs["background"])
+        gt_rgb = self.get_composited_gt(batch["image"], outputs["background"])
         metrics_dict = {}
         predicted_rgb = outputs["rgb"]
         metrics_dict["psnr"] = self.psnr(predicted_rgb, gt_rgb)
@@ -1063,7 +1506,7 @@ class LLGaussianSplattingModel(SplatfactoModel):
             batch: ground truth batch corresponding to outputs
             metrics_dict: dictionary of metrics, some of which we can use for loss
         """
-        gt_img = self.composite_with_background(self.get_gt_img(batch["image"]), outputs["background"])
+        gt_img = self.get_composited_gt(batch["image"], outputs["background"])
         pred_img = outputs["rgb"]
 
         # Set masked part of both ground-truth and rendered image to black.
@@ -1076,20 +1519,12 @@ class LLGaussianSplattingModel(SplatfactoModel):
             gt_img = gt_img * mask
             pred_img = pred_img * mask
 
-        Ll1 = torch.abs(gt_img - pred_img).mean()
+        Ll1 = l1_loss(gt_img, pred_img)
         simloss = 1 - self.ssim(gt_img.permute(2, 0, 1)[None, ...], pred_img.permute(2, 0, 1)[None, ...])
         if self.config.use_scale_regularization and self.step % 10 == 0:
-            scale_exp = torch.exp(self.scales)
-            scale_reg = (
-                torch.maximum(
-                    scale_exp.amax(dim=-1) / scale_exp.amin(dim=-1),
-                    torch.tensor(self.config.max_gauss_ratio),
-                )
-                - self.config.max_gauss_ratio
-            )
-            scale_reg = 0.1 * scale_reg.mean()
+            scale_reg = scale_ratio_loss(self.scales, self.config.max_gauss_ratio)
         else:
-            scale_reg = torch.tensor(0.0).to(self.device)
+            scale_reg = torch.zeros((), device=self.device)
 
         loss_dict = {
             "main_loss": (1 - self.config.ssim_lambda) * Ll1 + self.config.ssim_lambda * simloss,
@@ -1097,10 +1532,9 @@ class LLGaussianSplattingModel(SplatfactoModel):
         }
 
         if self.training and 'clip' in outputs and 'clip' in batch: 
-            unreduced_clip = self.config.clip_loss_weight * torch.nn.functional.huber_loss(
-                outputs["clip"], batch["clip"].to(self.device).to(torch.float32), delta=1.25, reduction="none"
+            loss_dict["clip_loss"] = clip_huber_loss(
+                outputs["clip"], batch["clip"].to(self.device), self.config.clip_loss_weight
             )
-            loss_dict["clip_loss"] = unreduced_clip.sum(dim=-1).nanmean()
 
         if self.training:
             # Add loss from camera optimizer
@@ -1166,19 +1600,9 @@ class LLGaussianSplattingModel(SplatfactoModel):
 
             # Do K nearest neighbors for each point and then avg the clip hash for each point based on the KNN
             # import pdb; pdb.set_trace()
-            means_freeze = self.means.data.clone().detach()
-            distances, indicies = self.k_nearest_sklearn(means_freeze, 3, True)
-            distances = torch.from_numpy(distances).to(self.device)
-            indicies = torch.from_numpy(indicies).view(-1)
-            weights = torch.sigmoid(self.opacities[indicies].view(-1, 4))
-            weights = torch.nn.Softmax(dim=-1)(weights)
-            points = means_freeze[indicies]
             # clip_hash_encoding = self.gaussian_lerf_field.get_hash(self.means)
-            clip_hash_encoding = self.gaussian_lerf_field.get_hash(points)
-            clip_hash_encoding = clip_hash_encoding.view(-1, 4, clip_hash_encoding.shape[1])
-            clip_hash_encoding = (clip_hash_encoding * weights.unsqueeze(-1))
-            clip_hash_encoding = clip_hash_encoding.sum(dim=1)
-            clip_feats = self.gaussian_lerf_field.get_outputs_from_feature(clip_hash_encoding, self.best_scales[0].to(self.device) * torch.ones(self.num_points, 1, device=self.device))[GaussianLERFFieldHeadNames.CLIP].to(dtype=torch.float32)
+            clip_hash_encoding = self.knn_clip_hash()
+            clip_feats = self.gaussian_lerf_field.get_outputs_from_feature(clip_hash_encoding, self.best_scales[0].to(self.device).expand(self.num_points, 1))[GaussianLERFFieldHeadNames.CLIP].to(dtype=torch.float32)
             relevancy = self.image_encoder.get_relevancy(clip_feats / (clip_feats.norm(dim=-1, keepdim=True)+1e-6), 0).view(self.num_points, -1)
             # color = apply_colormap(relevancy[..., 0:1])
             # self.viewer_control.viser_server.add_point_cloud("relevancy", self.means.numpy(force=True) * 10, color.numpy(force=True), 0.01)
@@ -1190,7 +1614,7 @@ class LLGaussianSplattingModel(SplatfactoModel):
             #Define all crop viewer elements
             # self.crop_points = relevancy[..., 0] > self.relevancy_thresh.value
             # self._crop_center_init = self.means[self.crop_points].mean(dim=0).cpu().numpy()
-            self._crop_center_init = means_freeze[relevancy[..., 0].argmax(dim=0).cpu().numpy()].cpu().numpy()
+            self._crop_center_init = self.means.data[relevancy[..., 0].argmax(dim=0)].numpy(force=True)
             # self.original_means = self.means.data.clone()
             
             query = self._crop_center_init / self.viser_scale_ratio
@@ -1242,21 +1666,13 @@ class LLGaussianSplattingModel(SplatfactoModel):
             # clip_feats = self.gaussian_lerf_field.get_outputs(self.means, self.best_scales[0].to(self.device) * torch.ones(self.num_points, 1, device=self.device))[GaussianLERFFieldHeadNames.CLIP].to(dtype=torch.float32)
 
             # Do K nearest neighbors for each point and then avg the clip hash for each point based on the KNN
-            distances, indicies = self.k_nearest_sklearn(self.means.data, 3, True)
-            distances = torch.from_numpy(distances).to(self.device)
-            indicies = torch.from_numpy(indicies).to(self.device).view(-1)
-            weights = torch.sigmoid(self.opacities[indicies].view(-1, 4))
-            weights = torch.nn.Softmax(dim=-1)(weights)
-            points = self.means[indicies]
             # clip_hash_encoding = self.gaussian_lerf_field.get_hash(self.means)
-            clip_hash_encoding = self.gaussian_lerf_field.get_hash(points)
-            clip_hash_encoding = clip_hash_encoding.view(-1, 4, clip_hash_encoding.shape[1])
-            clip_hash_encoding = (clip_hash_encoding * weights.unsqueeze(-1))
-            clip_hash_encoding = clip_hash_encoding.sum(dim=1)
-            clip_feats = self.gaussian_lerf_field.get_outputs_from_feature(clip_hash_encoding, self.best_scales[0].to(self.device) * torch.ones(self.num_points, 1, device=self.device))[GaussianLERFFieldHeadNames.CLIP].to(dtype=torch.float32)
+            clip_hash_encoding = self.knn_clip_hash()
+            clip_feats = self.gaussian_lerf_field.get_outputs_from_feature(clip_hash_encoding, self.best_scales[0].to(self.device).expand(self.num_points, 1))[GaussianLERFFieldHeadNames.CLIP].to(dtype=torch.float32)
             relevancy = self.image_encoder.get_relevancy(clip_feats / (clip_feats.norm(dim=-1, keepdim=True)+1e-6), 0).view(self.num_points, -1)
             color = apply_colormap(relevancy[..., 0:1])
-            self.viewer_control.viser_server.add_point_cloud("relevancy", self.means.numpy(force=True) * 10, color.numpy(force=True), 0.01)
+            # scale on the gpu so only the scaled points are synced to host
+            self.viewer_control.viser_server.add_point_cloud("relevancy", (self.means * 10).numpy(force=True), color.numpy(force=True), 0.01)
 
             # Add a slider to debug the relevancy values
             
@@ -1264,8 +1680,13 @@ class LLGaussianSplattingModel(SplatfactoModel):
             
             #Define all crop viewer elements
             self.crop_points = relevancy[..., 0] > self.relevancy_thresh.value
-            self._crop_center_init = self.means[self.crop_points].mean(dim=0).cpu().numpy()
-            self.original_means = self.means.data.clone()
+            # resolved to indices once here, every handle drag gathers/scatters with them instead of rescanning the mask
+            self._crop_idx = self.crop_points.nonzero(as_tuple=True)[0]
+            # the full snapshot is only needed again by reset_crop_cb, so it waits in pinned host memory instead of
+            # holding a second copy of every mean on the gpu. Drags only ever need the cropped subset, kept on device
+            self.original_means = self.means.data.to("cpu", copy=True).pin_memory()
+            self._original_crop_means = self.means.index_select(0, self._crop_idx)
+            self._crop_center_init = self._original_crop_means.mean(dim=0).cpu().numpy()
 
             self._crop_handle = self.viewer_control.viser_server.add_transform_controls("Crop Points", depth_test=False, line_width=4.0)
             world_center = tuple(p / self.viser_scale_ratio for p in self._crop_center_init)
@@ -1278,67 +1699,79 @@ class LLGaussianSplattingModel(SplatfactoModel):
                     return
                 # import pdb; pdb.set_trace()
                 new_center = np.array(self._crop_handle.position) * self.viser_scale_ratio
-                delta = new_center - self._crop_center_init
-                displacement = torch.zeros_like(self.means)
-                displacement[self.crop_points] = torch.from_numpy(delta).to(self.device).to(self.means.dtype)
-                
-                curr_to_world = torch.from_numpy(vtf.SE3(np.concatenate((self._crop_handle.wxyz, self._crop_handle.position * self.viser_scale_ratio))).as_matrix()).to(self.device).to(self.means.dtype)
-                transform = torch.from_numpy(vtf.SE3(np.concatenate((self._crop_handle.wxyz, (self._crop_handle.position * self.viser_scale_ratio) - self._crop_center_init))).as_matrix()).to(self.device).to(self.means.dtype)
-
-                print(f"transform {transform}")
-                transformed_points = self.original_means.clone()
-                homogeneous_points = torch.cat((transformed_points[self.crop_points], torch.ones(transformed_points[self.crop_points].shape[0], 1, device=self.device, dtype=self.means.dtype)), dim=1)
-                transformed_homogeneous = curr_to_world @ transform @ torch.inverse(curr_to_world) @ homogeneous_points.transpose(0,1)
-                transformed_homogeneous = transformed_homogeneous.transpose(0,1)
-                transformed_points[self.crop_points] = transformed_homogeneous[:, :3] / transformed_homogeneous[:, 3:4]
-                self.means.data = transformed_points
+                # curr_to_world @ transform @ inv(curr_to_world) with both sharing the handle rotation R collapses to
+                # x -> R (x - crop_center_init) + new_center, so build R and t on the host and apply them in one kernel
+                rot = vtf.SO3(np.asarray(self._crop_handle.wxyz)).as_matrix()
+                trans = new_center - rot @ self._crop_center_init
+                # packed as one [R | t] so it's a single host to device copy
+                rot_trans = torch.from_numpy(np.concatenate((rot, trans[:, None]), axis=1)).to(self.device, self.means.dtype)
+                rot, trans = rot_trans[:, :3], rot_trans[:, 3]
+
+                # write the cropped means in place, no full size temporaries and the parameter keeps its storage.
+                # trans + points @ rot.T is a single addmm
+                self.means.data.index_copy_(0, self._crop_idx, torch.addmm(trans, self._original_crop_means, rot.T))
+                self._invalidate_means_caches()
 
             # self._crop_center.value = tuple(p / self.viser_scale_ratio for p in self._crop_center_init)
 
             self.viewer_control.viser_server.add_point_cloud("Centroid", self._crop_center_init / self.viser_scale_ratio, np.array([0,0,0]), 0.1)
 
+    def _invalidate_means_caches(self):
+        """
+        Drops the caches derived from the means after the viewer moves them through .data. Those writes don't bump
+        the version counter (so a training step in flight on the other thread can't trip autograd), which means the
+        (_version, data_ptr, shape) keys can't see them
+        """
+        self._clip_hash_cache = None
+        self._knn_cache = None
+        self._knn_hash_cache = None
+
     def reset_crop_cb(self,element):
         self.crop_ids = None#torch.ones_like(self.means[:,0],dtype=torch.bool)
-        self.means.data = self.original_means
+        self.means.data.copy_(self.original_means, non_blocking=True)
+        self._invalidate_means_caches()
         self._crop_center_init = None
         self._crop_handle.visible = False
         
-    def get_max_across(self, means_crop, quats_crop, scales_crop, opacities_crop, viewmat, K, H, W, preset_scales=None):
+    def get_max_across(self, means_crop, quats_crop, scales_act, opacities_act, viewmat, K, H, W, preset_scales=None, crop_idx=None):
+        """
+        quats_crop is expected to be normalized already (see normalized_quats), and scales_act/opacities_act
+        already activated (see activate_gaussians) so the RGB pass's activations are reused.
+        crop_idx: indices the *_crop tensors were gathered with, None if they cover every gaussian
+        """
         # probably not a good idea bc it's prob going to be a lot of memory
-        n_phrases = len(self.image_encoder.positives)
-        n_phrases_maxs = [None for _ in range(n_phrases)]
-        n_phrases_sims = [None for _ in range(n_phrases)]
-        scales_list = torch.linspace(0.0, 1.5, 30).to(self.device)
+        scales_list = self._scales_list
         # scales_list = [0.1]
-        all_probs = []
-        BLOCK_WIDTH = 16
 
         with torch.no_grad():
-            clip_hash_encoding = self.gaussian_lerf_field.get_hash(self.means)
+            clip_hash_encoding = self.clip_hash()
+            if crop_idx is not None:
+                clip_hash_encoding = clip_hash_encoding.index_select(0, crop_idx)
+            # the hash is rasterized as float32: gsplat's rasterize_to_pixels only blends float features, so int8/fp16
+            # features would just be upcast again before the blend and quantizing them saves no bandwidth here
+            # a gaussian's alpha never exceeds its opacity, so ones under the rasterizer's 1/255 alpha cutoff can't
+            # touch any pixel. Drop them before projection so they don't cost tile intersections or sorting
+            visible = (opacities_act >= 1.0 / 255.0).nonzero(as_tuple=True)[0]
+            if visible.numel() < opacities_act.shape[0]:
+                means_crop = means_crop.index_select(0, visible)
+                quats_crop = quats_crop.index_select(0, visible)
+                scales_act = scales_act.index_select(0, visible)
+                opacities_act = opacities_act.index_select(0, visible)
+                clip_hash_encoding = clip_hash_encoding.index_select(0, visible)
             # print(type(clip_hash_encoding))
             # print(clip_hash_encoding.ndimension())
             # print(clip_hash_encoding.size(1))
             # import pdb; pdb.set_trace()
-            field_output, alpha, info = rasterization(
-                        means=means_crop,
-                        quats=quats_crop / quats_crop.norm(dim=-1, keepdim=True),
-                        scales=torch.exp(scales_crop),
-                        opacities=torch.sigmoid(opacities_crop).squeeze(-1),
-                        colors=clip_hash_encoding,
-                        viewmats=viewmat, # [1, 4, 4]
-                        Ks=K,  # [1, 3, 3]
-                        width=W,
-                        height=H,
-                        tile_size=BLOCK_WIDTH,
-                        packed=False,
-                        near_plane=0.01,
-                        far_plane=1e10,
-                        render_mode="RGB",
-                        sparse_grad=False,
-                        absgrad=True,
-                        rasterize_mode=self.config.rasterize_mode,
-                        # set some threshold to disregrad small gaussians for faster rendering.
-                        # radius_clip=3.0,
+            field_output, alpha, info = self.rasterize(
+                means_crop,
+                quats_crop,
+                scales_act,
+                opacities_act,
+                clip_hash_encoding,
+                viewmat,
+                K,
+                W,
+                H,
             )
             # clip_output = rasterize_gaussians(
             #                 xys,
@@ -1359,31 +1792,123 @@ class LLGaussianSplattingModel(SplatfactoModel):
             #             )
             # Normalize the clip output
             # clip_output = clip_output / (clip_output.norm(dim=-1, keepdim=True) + 1e-6)
+        if TORCH_2_1 and self.config.relevancy_cuda_graph and not self._relevancy_graph_failed and field_output.is_cuda:
+            best_sims, best_scales = self.relevancy_sweep_graphed(field_output.view(H * W, -1), scales_list, preset_scales is not None)
+        else:
+            # the rendered features are the same for every scale, copy them into the clip net input once and only
+            # rewrite the scale column per scale
+            clip_input = field_output.new_empty((H * W, field_output.shape[-1] + 1))
+            clip_input[:, :-1] = field_output.view(H * W, -1)
+            best_sims, best_scales = self.relevancy_sweep(clip_input, scales_list, preset_scales is not None)
+        # print(f"Best scales: {best_scales}")#, Words: {self.image_encoder.positives}, Scale List: {scales_list}")
+        return best_sims.unsqueeze(-1), best_scales#, relevancy_rasterized
+
+    @torch.no_grad()
+    def relevancy_sweep(self, clip_input, scales_list, preset, out=None):
+        """
+        Runs the clip net over clip_input (rendered features + a scale column) for every scale and keeps, per phrase,
+        the relevancy map and scale with the highest max relevancy. With preset, phrase i is only scored at scale i.
+        out: optional (best_sims, best_scales, best_max) buffers to write into, so the sweep can be graph captured
+        """
+        n_phrases = len(self.image_encoder.positives)
+        if out is None:
+            best_sims = clip_input.new_empty((n_phrases, clip_input.shape[0]), dtype=torch.float32)
+            best_scales = scales_list.new_empty(n_phrases)
+            best_max = best_scales.new_empty(n_phrases, dtype=torch.float32)
+        else:
+            best_sims, best_scales, best_max = out
+        # running best per phrase, kept on device and updated in place so the sweep never syncs to compare maxima
+        # and doesn't allocate new running state every scale
+        best_sims.zero_()
+        best_scales.zero_()
+        best_max.fill_(-float("inf"))
+        # with preset, phrase j is only scored at scale j, built once instead of comparing phrase ids every scale
+        preset_mask = torch.eye(n_phrases, len(scales_list), dtype=torch.bool, device=clip_input.device) if preset else None
+        # stays a python loop rather than a torch.vmap over scales_list: the clip net is a tcnn autograd Function
+        # with no vmap rule, and batching the scales would hold 30 (H*W, 512) outputs at once. The launch overhead
+        # the loop costs is what relevancy_sweep_graphed's replay removes
         for i, scale in enumerate(scales_list):
-            with torch.no_grad():
-                clip_output_im = self.gaussian_lerf_field.get_outputs_from_feature(field_output.view(H*W, -1), scale * torch.ones(H*W, 1, device=self.device))[GaussianLERFFieldHeadNames.CLIP].to(dtype=torch.float32).view(H, W, -1)
-
-            for j in range(n_phrases):
-                if preset_scales is None or j == i:
-                    # relevancy_rasterized = NDRasterizeGaussians.apply(
-                    #         xys,
-                    #         depths,
-                    #         radii,
-                    #         conics,
-                    #         num_tiles_hit,
-                    #         self.image_encoder.get_relevancy(self.gaussian_lerf_field.get_outputs_from_feature(self.clip_hash / self.clip_hash.norm(dim=-1, keepdim=True), scale * torch.ones(self.num_points, 1, device=self.device))[GaussianLERFFieldHeadNames.CLIP].view(self.num_points, -1).to(dtype=torch.float32), j)[..., 0:1],
-                    #         opacities,
-                    #         h,
-                    #         w,
-                    #         torch.zeros(1, device=self.device),
-                    #     )
-                    
-                    probs = self.image_encoder.get_relevancy(clip_output_im.view(-1, self.image_encoder.embedding_dim), j)
-                    pos_prob = probs[..., 0:1]
-                    all_probs.append((pos_prob.max(), scale))
-                    if n_phrases_maxs[j] is None or pos_prob.max() > n_phrases_sims[j].max():
-                        n_phrases_maxs[j] = scale
-                        n_phrases_sims[j] = pos_prob
-        # print(f"Best scales: {n_phrases_maxs}")#, Words: {self.image_encoder.positives}, Scale List: {scales_list}, All probs: {all_probs}")
-        # import pdb; pdb.set_trace()
-        return torch.stack(n_phrases_sims), torch.Tensor(n_phrases_maxs)#, relevancy_rasterized
+            clip_input[:, -1] = scale
+            # the clip net is already half precision, keeping its normalized output in half too halves the traffic of
+            # the (H*W, 512) features. get_positive_relevancies upcasts them for the similarity GEMM
+            clip_output = self.gaussian_lerf_field.get_outputs_from_input(clip_input, RELEVANCY_DTYPE)[GaussianLERFFieldHeadNames.CLIP]
+
+            # relevancy to every positive in one matmul, rays x phrases
+            pos_probs = self.image_encoder.get_positive_relevancies(clip_output).T
+            pos_max = pos_probs.amax(dim=-1)
+            update = pos_max > best_max
+            if preset:
+                update &= preset_mask[:, i]
+            torch.where(update[:, None], pos_probs, best_sims, out=best_sims)
+            torch.where(update, scale, best_scales, out=best_scales)
+            torch.where(update, pos_max, best_max, out=best_max)
+        return best_sims, best_scales
+
+    # render sizes kept captured at once, the viewer alternates between its moving and static resolutions. Each graph
+    # holds a private pool with the sweep's (H*W, 512) intermediates, so no more than those two
+    _MAX_RELEVANCY_GRAPHS = 2
+
+    @torch.no_grad()
+    def relevancy_sweep_graphed(self, features, scales_list, preset):
+        """
+        relevancy_sweep through a CUDA graph. The sweep is ~30 * (clip net + relevancy) small launches on fixed
+        shapes, so it's captured per (render size, feature dim, phrases) and replayed, with only the rendered
+        features copied in. A key is only captured the second time it's seen, so one-off sizes don't pay for the
+        warmup and capture, and a few are kept so switching between the viewer's resolutions doesn't recapture.
+        The rasterization itself has data dependent sizes and stays outside the graph.
+        """
+        # the embeddings get_positive_relevancies multiplies with (and so the graph captures)
+        phrases = self.image_encoder.get_phrases_embeds(torch.float32)
+        if phrases is not self._relevancy_graph_phrases:
+            # every graph baked in the old embeddings, drop them (and their memory pools)
+            self._relevancy_graphs.clear()
+            self._relevancy_graph_phrases = phrases
+        key = (features.shape, features.dtype, len(self.image_encoder.positives), preset, scales_list.data_ptr())
+        graphs = self._relevancy_graphs
+
+        def eager():
+            clip_input = features.new_empty((features.shape[0], features.shape[1] + 1))
+            clip_input[:, :-1] = features
+            return self.relevancy_sweep(clip_input, scales_list, preset)
+
+        if key not in graphs:
+            graphs[key] = None
+            while len(graphs) > self._MAX_RELEVANCY_GRAPHS:
+                graphs.popitem(last=False)
+            return eager()
+        graphs.move_to_end(key)
+        entry = graphs[key]
+        if entry is None:
+            n_phrases = len(self.image_encoder.positives)
+            clip_input = features.new_empty((features.shape[0], features.shape[1] + 1))
+            clip_input[:, :-1] = features
+            out = (
+                features.new_empty((n_phrases, features.shape[0]), dtype=torch.float32),
+                scales_list.new_empty(n_phrases),
+                features.new_empty(n_phrases, dtype=torch.float32),
+            )
+            # warm up on a side stream (compiles the helpers, lets tcnn size its workspace) before capturing
+            side = torch.cuda.Stream()
+            side.wait_stream(torch.cuda.current_stream())
+            with torch.cuda.stream(side):
+                for _ in range(3):
+                    self.relevancy_sweep(clip_input, scales_list, preset, out=out)
+            torch.cuda.current_stream().wait_stream(side)
+            graph = torch.cuda.CUDAGraph()
+            try:
+                # thread local: training keeps running (and allocating) on the main thread during the capture, which
+                # a global capture would turn into errors on that thread
+                with torch.cuda.graph(graph, capture_error_mode="thread_local"):
+                    self.relevancy_sweep(clip_input, scales_list, preset, out=out)
+            except RuntimeError as e:
+                CONSOLE.log(f"[yellow]Capturing the relevancy sweep failed, running it eagerly: {e}")
+                self._relevancy_graph_failed = True
+                graphs.clear()
+                return eager()
+            entry = graphs[key] = (graph, clip_input, out)
+        else:
+            entry[1][:, :-1] = features
+        entry[0].replay()
+        # the static outputs are overwritten by the next replay and the caller thresholds them in place
+        best_sims, best_scales, _ = entry[2]
+        return best_sims.clone(), best_scales.clone()